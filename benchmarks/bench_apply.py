@@ -0,0 +1,226 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Times WeTransactionHandler.apply on an in-memory context.
+
+Each scenario applies set transactions for consecutive hours with the
+same participants and reports the apply time, the state calls and the
+bytes written per transaction. The logging scenario runs with DEBUG
+logging off and on, the index scenario runs set with and without the
+participant index:
+
+    python benchmarks/bench_apply.py -participants 10000 -iterations 200
+"""
+
+import argparse
+import datetime
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import statistics
+import time
+
+from sawtooth_we.processor.handler import WeTransactionHandler
+
+
+class _Entry:
+    def __init__(self, address, data):
+        self.address = address
+        self.data = data
+
+
+class FakeContext:
+    """The subset of sawtooth_sdk Context used by the handler, counting
+    the state calls.
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.reads = 0
+        self.read_addresses = 0
+        self.writes = 0
+        self.written_addresses = 0
+        self.written_bytes = 0
+        self.events = 0
+
+    def get_state(self, addresses, timeout=None):
+        self.reads += 1
+        self.read_addresses += len(addresses)
+        return [
+            _Entry(address, self.state[address])
+            for address in addresses if address in self.state]
+
+    def set_state(self, entries, timeout=None):
+        self.writes += 1
+        self.written_addresses += len(entries)
+        self.written_bytes += sum(len(data) for data in entries.values())
+        self.state.update(entries)
+        return list(entries)
+
+    def delete_state(self, addresses, timeout=None):
+        self.writes += 1
+        for address in addresses:
+            self.state.pop(address, None)
+        return list(addresses)
+
+    def add_event(self, event_type, attributes=None, data=None):
+        self.events += 1
+
+
+class _Header:
+    signer_public_key = '02' + '00' * 32
+
+
+class _Transaction:
+    def __init__(self, payload):
+        self.header = _Header()
+        self.payload = payload
+
+
+def make_payloads(participants, count, flags=(), seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2021, 1, 1)
+    listId = ",".join(str(i) for i in range(1, participants + 1))
+    payloads = []
+    for hour in range(count):
+        name = (start + datetime.timedelta(hours=hour)).strftime(
+            '%Y_%m_%d_%H')
+        fields = [
+            name, 'set', listId,
+            ",".join(str(rng.randint(0, 3000)) for _ in range(participants))]
+        if flags:
+            fields.append(",".join(flags))
+        payloads.append("-".join(fields).encode())
+    return payloads
+
+
+def run(payloads, handler=None):
+    """Applies the payloads in order on a fresh context.
+
+    Returns:
+        (tuple): the apply durations in seconds (list of float) and the
+            FakeContext.
+    """
+    handler = handler or WeTransactionHandler()
+    context = FakeContext()
+    durations = []
+    for payload in payloads:
+        transaction = _Transaction(payload)
+        start = time.perf_counter()
+        handler.apply(transaction, context)
+        durations.append(time.perf_counter() - start)
+    return durations, context
+
+
+def report(label, durations, context):
+    count = len(durations)
+    ordered = sorted(durations)
+    print('{:<28} {:>9.3f} {:>9.3f} {:>9.3f} {:>7.2f} {:>7.2f} {:>10.0f}'
+          .format(
+              label,
+              statistics.mean(durations) * 1000,
+              ordered[count // 2] * 1000,
+              ordered[min(count - 1, count * 99 // 100)] * 1000,
+              context.reads / count,
+              context.writes / count,
+              context.written_bytes / count))
+
+
+def _queue_logging(level):
+    """Configures the root logger the way processor/main.py does: a
+    QueueHandler in front of a file handler written by a listener thread.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+    records = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(
+        records, logging.FileHandler(os.devnull),
+        respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def bench_logging(payloads):
+    for label, level in (('logging off', logging.WARNING),
+                         ('logging DEBUG', logging.DEBUG)):
+        listener = _queue_logging(level)
+        try:
+            durations, context = run(payloads)
+        finally:
+            listener.stop()
+        report(label, durations, context)
+
+
+def bench_index(participants, iterations):
+    """Compares set with and without the participant index. The index
+    reads the head of every participant, then its last page, and writes
+    both for every participant.
+    """
+    for label, flags in (('set', ()), ('set with index', ('index',))):
+        durations, context = run(
+            make_payloads(participants, iterations, flags=flags))
+        report(label, durations, context)
+        count = len(durations)
+        print('{:<28} {:>10.0f} addresses read, {:.0f} written per '
+              'transaction'.format(
+                  '', context.read_addresses / count,
+                  context.written_addresses / count))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Times WeTransactionHandler.apply on a fake context')
+    parser.add_argument(
+        '-participants',
+        type=int,
+        default=10000,
+        help='specify the number of participants of each record')
+    parser.add_argument(
+        '-iterations',
+        type=int,
+        default=100,
+        help='specify the number of transactions applied per scenario')
+    parser.add_argument(
+        '-scenario',
+        choices=['all', 'logging', 'index'],
+        default='all',
+        help='specify the scenarios to run')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    payloads = make_payloads(args.participants, args.iterations)
+    # Warm up the imports and caches before timing
+    run(payloads[:3])
+
+    print('{} participants, {} transactions per scenario'.format(
+        args.participants, args.iterations))
+    print('{:<28} {:>9} {:>9} {:>9} {:>7} {:>7} {:>10}'.format(
+        'scenario', 'mean ms', 'p50 ms', 'p99 ms', 'reads', 'writes',
+        'bytes'))
+    if args.scenario in ('all', 'logging'):
+        bench_logging(payloads)
+    if args.scenario in ('all', 'index'):
+        bench_index(args.participants, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
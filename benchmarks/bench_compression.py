@@ -0,0 +1,129 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Measures the compression of hourly records sent with setcompressed.
+
+For every participant count and method, reports the size of the state
+entry and of the payload, the compression ratio, and the CPU time per
+record to compress it on the client, to check the payload on a validator
+and to decompress the entry on read:
+
+    python benchmarks/bench_compression.py -participants 1000 3000 10000
+"""
+
+import argparse
+import base64
+import time
+
+from sawtooth_we.we_corpus import synthetic_records
+from sawtooth_we.processor.we_payload import WePayload
+from sawtooth_we.processor.we_state import COMPRESS_ZDICT
+from sawtooth_we.processor.we_state import COMPRESS_ZLIB
+from sawtooth_we.processor.we_state import compress_entry
+from sawtooth_we.processor.we_state import decompress_entry
+
+
+METHODS = (('none', None), ('zlib', COMPRESS_ZLIB), ('zdict', COMPRESS_ZDICT))
+
+
+def make_records(participants, count):
+    """Returns (name, serialization) of count hourly records."""
+    return [
+        (name, "-".join([
+            name,
+            ",".join(str(i) for i in listId),
+            ",".join(str(c) for c in listConsumption)]).encode())
+        for name, listId, listConsumption in synthetic_records(
+            count, participants, seed=0)]
+
+
+def make_payload(name, serialization, method):
+    """Builds the payload WeClient sends for the record."""
+    if method is None:
+        _, listId, listConsumption = serialization.decode().split("-")
+        return "-".join([name, "set", listId, listConsumption]).encode()
+    return "-".join([
+        name, "setcompressed",
+        base64.b64encode(compress_entry(serialization, method)).decode()
+    ]).encode()
+
+
+def _cpu_time(function, items):
+    """Returns the mean CPU time of function over items, in ms."""
+    start = time.process_time()
+    for item in items:
+        function(item)
+    return (time.process_time() - start) * 1000 / len(items)
+
+
+def bench(participants, count):
+    records = make_records(participants, count)
+    raw = sum(len(serialization) for _, serialization in records)
+    for label, method in METHODS:
+        if method is None:
+            entries = [serialization for _, serialization in records]
+            compress_ms = 0.0
+        else:
+            entries = [
+                compress_entry(serialization, method)
+                for _, serialization in records]
+            compress_ms = _cpu_time(
+                lambda record, method=method: compress_entry(
+                    record[1], method),
+                records)
+        payloads = [
+            make_payload(name, serialization, method)
+            for name, serialization in records]
+        validate_ms = _cpu_time(WePayload.from_bytes, payloads)
+        read_ms = _cpu_time(decompress_entry, entries)
+        stored = sum(len(entry) for entry in entries)
+        print('{:>8} {:<6} {:>10.0f} {:>10.0f} {:>6.2f} {:>11.3f} {:>11.3f} '
+              '{:>9.3f}'.format(
+                  participants, label,
+                  stored / count,
+                  sum(len(payload) for payload in payloads) / count,
+                  raw / stored, compress_ms, validate_ms, read_ms))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measures the compression of hourly records')
+    parser.add_argument(
+        '-participants',
+        type=int,
+        nargs='+',
+        default=[1000, 3000, 10000],
+        help='specify the numbers of participants of the records')
+    parser.add_argument(
+        '-iterations',
+        type=int,
+        default=50,
+        help='specify the number of records measured per method')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print('{} records per method, CPU times per record'.format(
+        args.iterations))
+    print('{:>8} {:<6} {:>10} {:>10} {:>6} {:>11} {:>11} {:>9}'.format(
+        'members', 'method', 'entry B', 'payload B', 'ratio',
+        'compress ms', 'validate ms', 'read ms'))
+    for participants in args.participants:
+        bench(participants, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
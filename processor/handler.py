@@ -14,9 +14,12 @@
 # ------------------------------------------------------------------------------
 
 import logging
+import struct
 
 from sawtooth_we.processor.we_payload import WePayload
 from sawtooth_we.processor.we_state import Energy
+from sawtooth_we.processor.we_state import Settlement
+from sawtooth_we.processor.we_state import Summary
 from sawtooth_we.processor.we_state import WeState
 from sawtooth_we.processor.we_state import WE_NAMESPACE
 
@@ -28,8 +31,28 @@ from sawtooth_sdk.processor.exceptions import InternalError
 
 LOGGER = logging.getLogger(__name__)
 
+# Bound of the binary delta carried by a we/energy-set event
+MAX_EVENT_DATA = 64 * 1024
+
+DELTA_ITEM = struct.Struct('>QQ')
+
+# Consumption of a participant of the previous record missing from the new
+# one. A real consumption of that value cannot be sent as a delta.
+DELTA_REMOVED = 2 ** 64 - 1
+
 
 class WeTransactionHandler(TransactionHandler):
+    """Handles the transactions of the we family.
+
+    Args:
+        event_deltas (bool): Attach to each we/energy-set event the packed
+            (id, consumption) pairs that changed, removed participants
+            having the consumption DELTA_REMOVED.
+    """
+
+    def __init__(self, event_deltas=False):
+        self._event_deltas = event_deltas
+
     # Disable invalid-overridden-method. The sawtooth-sdk expects these to be
     # properties.
     # pylint: disable=invalid-overridden-method
@@ -50,12 +73,21 @@ class WeTransactionHandler(TransactionHandler):
         signer = header.signer_public_key
 
         we_payload = WePayload.from_bytes(transaction.payload)
-        print('apply in handler ok 2!')
+        LOGGER.debug(
+            'Applying %s of %s', we_payload.action, we_payload.name)
 
         we_state = WeState(context)
 
-        if we_payload.action == 'set':
-            energy = we_state.get_energy(we_payload.name)
+        if we_payload.action in ('set', 'setcompressed'):
+            blind = 'blind' in we_payload.flags
+            if blind:
+                # No state read: the event delta then holds every value
+                energy = None
+                previous = None
+            else:
+                energy = we_state.get_energy(we_payload.name)
+                previous = None if energy is None \
+                    else (energy.listId, energy.listConsumption)
 
             if energy is None:
                 energy = Energy(name = we_payload.name, listId = we_payload.listId, listConsumption = we_payload.listConsumption)
@@ -66,11 +98,284 @@ class WeTransactionHandler(TransactionHandler):
             energy.listConsumption = we_payload.listConsumption
             energy.name = we_payload.name
 
-            we_state.set_energy(we_payload.name, energy)
-            
+            if we_payload.entry is not None:
+                we_state.set_compressed_energy(
+                    we_payload.name, we_payload.entry, blind=blind)
+            else:
+                we_state.set_energy(we_payload.name, energy, blind=blind)
+
+            if 'index' in we_payload.flags:
+                written = we_state.index_participants(
+                    we_payload.name,
+                    _parse_ints(we_payload.listId, we_payload.name))
+                LOGGER.debug(
+                    'Indexed %s: %d index addresses written',
+                    we_payload.name, written)
+
+            self._add_set_event(context, we_payload, previous)
+
+        elif we_payload.action == 'rollup':
+            if we_payload.level == 'day':
+                summary = _rollup_energies(
+                    we_payload.name,
+                    we_state.get_energies(we_payload.members))
+            else:
+                summary = _rollup_summaries(
+                    we_payload.name,
+                    we_state.get_summaries(we_payload.members))
+            we_state.set_summary(summary)
+
+        elif we_payload.action == 'setshard':
+            _check_shard_range(we_payload)
+            # Shards of other splits would overlap or leave gaps
+            splits = we_state.get_manifest(we_payload.name)
+            if splits is None:
+                raise InvalidTransaction(
+                    'No manifest for the shards of {}'.format(
+                        we_payload.name))
+            if splits != we_payload.splits:
+                raise InvalidTransaction(
+                    'The shard splits of {} differ from its manifest'.format(
+                        we_payload.name))
+            we_state.set_shard(
+                we_payload.shard,
+                Energy(
+                    name=we_payload.name,
+                    listId=we_payload.listId,
+                    listConsumption=we_payload.listConsumption))
+
+            # Shards are written without being read, the delta holds
+            # every value of the shard
+            self._add_set_event(context, we_payload, None)
+
+        elif we_payload.action == 'manifest':
+            we_state.set_manifest(we_payload.name, we_payload.splits)
+
+        elif we_payload.action == 'settle':
+            energy = we_state.get_energy(we_payload.name)
+            if energy is None:
+                raise InvalidTransaction(
+                    'No hourly record to settle for {}'.format(
+                        we_payload.name))
+            we_state.set_settlement(
+                _settle(energy, we_payload.producers))
+
+        elif we_payload.action == 'archive':
+            removed = we_state.delete_energies(we_payload.members)
+            LOGGER.debug(
+                'Archived %d of %d names older than %s', removed,
+                len(we_payload.members), we_payload.name)
+
         else:
             raise InvalidTransaction('Unhandled action in WeTransaction Handler apply: {}'.format(
                 we_payload.action))
-        
-        print('end apply')
 
+    def _add_set_event(self, context, we_payload, previous):
+        """Emits a we/energy-set event summing up the record, so that
+        subscribers do not need to read the state entry again. A shard of
+        a sharded record emits its own event, with its shard index and
+        the number of shards.
+        """
+        listId = _parse_ints(we_payload.listId, we_payload.name)
+        listConsumption = _parse_ints(
+            we_payload.listConsumption, we_payload.name)
+        attributes = [
+            ('name', we_payload.name),
+            ('participants', str(len(listId))),
+            ('total', str(sum(listConsumption))),
+        ]
+        if we_payload.shard is not None:
+            attributes.extend([
+                ('shard', str(we_payload.shard)),
+                ('shards', str(len(we_payload.splits) + 1)),
+            ])
+
+        data = None
+        if self._event_deltas:
+            try:
+                data = _pack_delta(listId, listConsumption, previous)
+            except struct.error:
+                # A value does not fit in 64 bits
+                data = None
+            if data is None:
+                # Keep events bounded, subscribers fall back to the state
+                attributes.append(('delta', 'truncated'))
+            else:
+                attributes.append(
+                    ('delta', str(len(data) // DELTA_ITEM.size)))
+
+        context.add_event(
+            event_type='we/energy-set',
+            attributes=attributes,
+            data=data)
+
+
+def _pack_delta(listId, listConsumption, previous):
+    """Packs the (id, consumption) pairs which differ from the previous
+    record as big-endian unsigned 64 bit integers. The participants of the
+    previous record missing from the new one are packed with the
+    consumption DELTA_REMOVED.
+
+    Returns:
+        (bytes): The packed pairs, None when they exceed MAX_EVENT_DATA
+            or a consumption is DELTA_REMOVED.
+    """
+    current = dict(zip(listId, listConsumption))
+    if DELTA_REMOVED in current.values():
+        return None
+    old = {}
+    if previous is not None:
+        try:
+            old = dict(zip(
+                _parse_ints(previous[0], 'previous record'),
+                _parse_ints(previous[1], 'previous record')))
+        except InvalidTransaction:
+            # A record stored before values were checked, send everything
+            pass
+    changed = {
+        participant: consumption
+        for participant, consumption in current.items()
+        if old.get(participant) != consumption}
+    changed.update(
+        (participant, DELTA_REMOVED)
+        for participant in old.keys() - current.keys())
+
+    if len(changed) * DELTA_ITEM.size > MAX_EVENT_DATA:
+        return None
+    return b''.join(
+        DELTA_ITEM.pack(participant, consumption)
+        for participant, consumption in sorted(changed.items()))
+
+
+def _parse_ints(values, name):
+    try:
+        return [int(value) for value in values.split(",")]
+    except ValueError as e:
+        raise InvalidTransaction(
+            'Non integer value in the record of {}'.format(name)) from e
+
+
+def _pro_rata(weights, amount):
+    """Splits amount in integers proportional to weights, summing exactly
+    to amount; the units left by flooring go to the largest remainders.
+    """
+    total = sum(weights)
+    if total == 0:
+        return [0] * len(weights)
+    shares, remainders = zip(
+        *(divmod(weight * amount, total) for weight in weights))
+    shares = list(shares)
+    left = amount - sum(shares)
+    for index in sorted(
+            range(len(weights)), key=lambda i: -remainders[i])[:left]:
+        shares[index] += 1
+    return shares
+
+
+def _settle(energy, producers):
+    """Nets the consumption of an hour against its production.
+
+    The energy produced inside the community covers as much consumption
+    as it can: every consumer receives a share of it proportional to its
+    consumption and every producer delivers a share proportional to its
+    production. The rest is imported from, or exported to, the grid.
+    """
+    listId = _parse_ints(energy.listId, energy.name)
+    listValue = _parse_ints(energy.listConsumption, energy.name)
+    unknown = set(producers).difference(listId)
+    if unknown:
+        raise InvalidTransaction(
+            'Producers {} are not part of {}'.format(
+                ",".join(str(p) for p in sorted(unknown)), energy.name))
+
+    producers = set(producers)
+    isProducer = [participant in producers for participant in listId]
+    produced = sum(v for v, p in zip(listValue, isProducer) if p)
+    consumed = sum(v for v, p in zip(listValue, isProducer) if not p)
+    local = min(produced, consumed)
+
+    delivered = _pro_rata(
+        [v if p else 0 for v, p in zip(listValue, isProducer)], local)
+    received = _pro_rata(
+        [0 if p else v for v, p in zip(listValue, isProducer)], local)
+    listLocal = [d + r for d, r in zip(delivered, received)]
+
+    return Settlement(
+        name=energy.name,
+        listId=listId,
+        producers=sorted(producers),
+        listLocal=listLocal,
+        listGrid=[v - l for v, l in zip(listValue, listLocal)],
+        communityImport=consumed - local,
+        communityExport=produced - local)
+
+
+def _check_shard_range(we_payload):
+    """Checks that every participant falls in the id range of the shard."""
+    splits = we_payload.splits
+    low = splits[we_payload.shard - 1] if we_payload.shard > 0 else None
+    high = splits[we_payload.shard] if we_payload.shard < len(splits) \
+        else None
+    for participant in _parse_ints(we_payload.listId, we_payload.name):
+        if (low is not None and participant < low) or \
+                (high is not None and participant >= high):
+            raise InvalidTransaction(
+                'Participant {} is not in shard {} of {}'.format(
+                    participant, we_payload.shard, we_payload.name))
+
+
+def _rollup_energies(name, energies):
+    """Sums hourly energies into the summary of a day."""
+    if not energies:
+        raise InvalidTransaction(
+            'No hourly record found for the rollup of {}'.format(name))
+
+    totals = {}
+    peakName = None
+    peakConsumption = None
+    for energy_name in sorted(energies):
+        energy = energies[energy_name]
+        listId = _parse_ints(energy.listId, energy_name)
+        listConsumption = _parse_ints(energy.listConsumption, energy_name)
+        for participant, consumption in zip(listId, listConsumption):
+            totals[participant] = totals.get(participant, 0) + consumption
+        hour_total = sum(listConsumption)
+        if peakConsumption is None or hour_total > peakConsumption:
+            peakName = energy_name
+            peakConsumption = hour_total
+
+    listId = sorted(totals)
+    return Summary(
+        name=name,
+        listId=listId,
+        listTotal=[totals[participant] for participant in listId],
+        total=sum(totals.values()),
+        peakName=peakName,
+        peakConsumption=peakConsumption,
+        count=len(energies))
+
+
+def _rollup_summaries(name, summaries):
+    """Sums daily summaries into the summary of a month."""
+    if not summaries:
+        raise InvalidTransaction(
+            'No daily summary found for the rollup of {}'.format(name))
+
+    totals = {}
+    peak = None
+    for summary_name in sorted(summaries):
+        summary = summaries[summary_name]
+        for participant, total in zip(summary.listId, summary.listTotal):
+            totals[participant] = totals.get(participant, 0) + total
+        if peak is None or summary.peakConsumption > peak.peakConsumption:
+            peak = summary
+
+    listId = sorted(totals)
+    return Summary(
+        name=name,
+        listId=listId,
+        listTotal=[totals[participant] for participant in listId],
+        total=sum(totals.values()),
+        peakName=peak.peakName,
+        peakConsumption=peak.peakConsumption,
+        count=sum(summary.count for summary in summaries.values()))
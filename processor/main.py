@@ -16,9 +16,14 @@
 import sys
 import os
 import argparse
+import logging
+import logging.handlers
+import queue
 import pkg_resources
 
 from sawtooth_we.processor.handler import WeTransactionHandler
+from sawtooth_we.processor.profiling import ProfilingController
+from sawtooth_we.processor.profiling import MODES as PROFILING_MODES
 from sawtooth_we.processor.config.we import WeConfig
 from sawtooth_we.processor.config.we import \
     load_default_we_config
@@ -51,6 +56,27 @@ def parse_args(args):
                         default=0,
                         help='Increase output sent to stderr')
 
+    parser.add_argument(
+        '--event-deltas',
+        action='store_true',
+        help='Attach the packed changed values to the we/energy-set events')
+
+    parser.add_argument(
+        '--profile-dir',
+        help='Enable on-demand profiling, writing the dumps to this '
+             'directory. SIGUSR1 toggles profiling.')
+
+    parser.add_argument(
+        '--profile-socket',
+        help='Unix socket accepting profiling commands '
+             '(start [cprofile|sample] [memory], stop, status)')
+
+    parser.add_argument(
+        '--profile-mode',
+        choices=PROFILING_MODES,
+        default='sample',
+        help='Profiling mode started by SIGUSR1')
+
     try:
         version = pkg_resources.get_distribution(DISTRIBUTION_NAME).version
     except pkg_resources.DistributionNotFound:
@@ -81,11 +107,45 @@ def create_we_config(args):
     return WeConfig(connect=args.connect)
 
 
+def _install_queue_logging():
+    """Moves the handlers of the root logger behind a queue.
+
+    The handler threads only enqueue their records; formatting and the
+    console and file writes happen in the listener thread.
+
+    Returns:
+        (logging.handlers.QueueListener): The started listener, to be
+            stopped on exit so the queued records are flushed.
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    records = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _install_profiling(handler, opts):
+    controller = ProfilingController(output_dir=opts.profile_dir)
+    # Shadow the bound method so the processor calls the wrapped apply
+    handler.apply = controller.wrap(handler.apply)
+    controller.install_signal_handler(mode=opts.profile_mode)
+    if opts.profile_socket is not None:
+        controller.serve_control_socket(opts.profile_socket)
+    return controller
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
     opts = parse_args(args)
     processor = None
+    listener = None
     try:
         arg_config = create_we_config(opts)
         we_config = load_we_config(arg_config)
@@ -106,9 +166,12 @@ def main(args=None):
                 name="we-" + str(processor.zmq_id)[2:-1])
 
         init_console_logging(verbose_level=opts.verbose)
+        listener = _install_queue_logging()
+
+        handler = WeTransactionHandler(event_deltas=opts.event_deltas)
 
-        handler = WeTransactionHandler()
-        print('main : handler = WeTransactionHandler() ok ')
+        if opts.profile_dir is not None:
+            _install_profiling(handler, opts)
 
         processor.add_handler(handler)
 
@@ -120,3 +183,5 @@ def main(args=None):
     finally:
         if processor is not None:
             processor.stop()
+        if listener is not None:
+            listener.stop()
@@ -0,0 +1,270 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+
+LOGGER = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sample')
+
+# Files whose allocations are reported: WePayload, WeState and Energy
+ALLOCATION_FILES = ('we_payload.py', 'we_state.py')
+
+
+class ProfilingController:
+    """Starts and stops profiling of the transaction handler at runtime.
+
+    Nothing is installed while profiling is inactive: the wrapped apply
+    only checks one attribute before calling through.
+
+    Args:
+        output_dir (str): The directory receiving the dump files.
+        sample_interval (float): Seconds between two stack samples.
+        top_allocations (int): The number of allocation sites reported.
+    """
+
+    def __init__(self, output_dir, sample_interval=0.005,
+                 top_allocations=25):
+        self._output_dir = output_dir
+        self._sample_interval = sample_interval
+        self._top_allocations = top_allocations
+        self._lock = threading.Lock()
+        # Held by stop while it dumps a session, so that start can not
+        # replace the session state or restart tracemalloc meanwhile
+        self._dump_lock = threading.Lock()
+        self._mode = None
+        self._memory = False
+        # One profiler at a time: from Python 3.12, cProfile sits on
+        # sys.monitoring and a second enabled profiler raises ValueError
+        self._profiler = None
+        self._profile_lock = threading.Lock()
+        self._samples = collections.Counter()
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._started = None
+        self._session = 0
+
+    @property
+    def active(self):
+        return self._mode is not None
+
+    def wrap(self, apply):
+        """Returns apply instrumented for the cProfile mode.
+
+        The single profiler is enabled around one call at a time; calls
+        made by other worker threads meanwhile run unprofiled.
+        """
+        def profiled_apply(transaction, context):
+            if self._mode != 'cprofile' or \
+                    not self._profile_lock.acquire(blocking=False):
+                return apply(transaction, context)
+            try:
+                # Profiling may have stopped while acquiring the lock
+                if self._mode != 'cprofile':
+                    return apply(transaction, context)
+                self._profiler.enable()
+                try:
+                    return apply(transaction, context)
+                finally:
+                    self._profiler.disable()
+            finally:
+                self._profile_lock.release()
+
+        return profiled_apply
+
+    def start(self, mode='sample', memory=False):
+        if mode not in MODES:
+            raise ValueError('Invalid profiling mode: {}'.format(mode))
+        with self._dump_lock, self._lock:
+            if self._mode is not None:
+                raise ValueError('Profiling already active')
+            self._profiler = cProfile.Profile() if mode == 'cprofile' \
+                else None
+            self._samples = collections.Counter()
+            self._memory = memory
+            self._session += 1
+            self._started = '{}-{}'.format(
+                time.strftime('%Y%m%d-%H%M%S'), self._session)
+            if memory:
+                tracemalloc.start(25)
+            if mode == 'sample':
+                self._stop_sampling.clear()
+                self._sampler = threading.Thread(
+                    target=self._sample, name='we-sampler', daemon=True)
+                self._sampler.start()
+            self._mode = mode
+        LOGGER.info('Started %s profiling (memory=%s)', mode, memory)
+
+    def stop(self):
+        """Stops profiling and writes the dump files.
+
+        Returns:
+            (list of str): The paths of the files written.
+        """
+        with self._dump_lock:
+            return self._stop()
+
+    def _stop(self):
+        with self._lock:
+            mode = self._mode
+            if mode is None:
+                raise ValueError('Profiling is not active')
+            self._mode = None
+
+        if self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+        os.makedirs(self._output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self._output_dir,
+            'we-{}-{}'.format(os.getpid(), self._started))
+
+        written = []
+        if mode == 'cprofile':
+            # Wait for the profiled apply in flight, if any, to return
+            with self._profile_lock:
+                profiler, self._profiler = self._profiler, None
+            try:
+                stats = pstats.Stats(profiler)
+            except TypeError:
+                # Nothing was profiled
+                stats = None
+            if stats is not None:
+                stats.dump_stats(prefix + '.pstats')
+                written.append(prefix + '.pstats')
+        if mode == 'sample':
+            with open(prefix + '.collapsed', 'w') as fd:
+                for stack, count in self._samples.most_common():
+                    fd.write('{} {}\n'.format(stack, count))
+            written.append(prefix + '.collapsed')
+        if self._memory:
+            written.extend(self._dump_allocations(prefix))
+
+        LOGGER.info('Stopped %s profiling, wrote %s', mode, written)
+        return written
+
+    def toggle(self, mode='sample', memory=True):
+        if self.active:
+            return self.stop()
+        self.start(mode=mode, memory=memory)
+        return []
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop_sampling.wait(self._sample_interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                # Collapsed stacks are root first, separated by ';'
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def _dump_allocations(self, prefix):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(prefix + '.tracemalloc')
+
+        filtered = snapshot.filter_traces([
+            tracemalloc.Filter(True, '*' + os.sep + filename)
+            for filename in ALLOCATION_FILES])
+        with open(prefix + '-allocations.txt', 'w') as fd:
+            for stat in filtered.statistics('lineno')[:self._top_allocations]:
+                fd.write('{}\n'.format(stat))
+        return [prefix + '.tracemalloc', prefix + '-allocations.txt']
+
+    def install_signal_handler(self, signum=signal.SIGUSR1, mode='sample',
+                               memory=True):
+        """Toggles profiling each time signum is received."""
+        def handle(_signum, _frame):
+            # Dumping may take a while, keep it out of the signal handler
+            threading.Thread(
+                target=self._safe_toggle, args=(mode, memory),
+                daemon=True).start()
+
+        signal.signal(signum, handle)
+
+    def _safe_toggle(self, mode, memory):
+        try:
+            self.toggle(mode=mode, memory=memory)
+        except ValueError as err:
+            LOGGER.warning('Profiling toggle failed: %s', err)
+
+    def serve_control_socket(self, path):
+        """Accepts commands on a local Unix socket, one per connection:
+
+            start [cprofile|sample] [memory]
+            stop
+            status
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(1)
+
+        thread = threading.Thread(
+            target=self._serve, args=(server,), name='we-profiling',
+            daemon=True)
+        thread.start()
+        return thread
+
+    def _serve(self, server):
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    command = conn.recv(1024).decode().split()
+                    conn.sendall((self._execute(command) + '\n').encode())
+                except (OSError, UnicodeDecodeError) as err:
+                    # The client went away, keep serving the next ones
+                    LOGGER.debug('Profiling command failed: %s', err)
+
+    def _execute(self, command):
+        try:
+            if not command:
+                return 'error: empty command'
+            if command[0] == 'start':
+                mode = command[1] if len(command) > 1 else 'sample'
+                self.start(mode=mode, memory='memory' in command[2:])
+                return 'started {}'.format(mode)
+            if command[0] == 'stop':
+                return 'wrote {}'.format(' '.join(self.stop()))
+            if command[0] == 'status':
+                return 'active {}'.format(self._mode) \
+                    if self.active else 'inactive'
+            return 'error: unknown command {}'.format(command[0])
+        except (OSError, ValueError) as err:
+            return 'error: {}'.format(err)
@@ -13,28 +13,273 @@
 # limitations under the License.
 # -----------------------------------------------------------------------------
 
+import base64
+import logging
+import time
+
+from sawtooth_we.processor.we_state import COMPRESSED_TAG
+from sawtooth_we.processor.we_state import MAX_ENTRY_SIZE
+from sawtooth_we.processor.we_state import decompress_entry
+
 from sawtooth_sdk.processor.exceptions import InvalidTransaction
 
 
+LOGGER = logging.getLogger(__name__)
+
+ACTIONS = ('set', 'setcompressed', 'rollup', 'setshard', 'manifest',
+           'archive', 'settle')
+
+ROLLUP_LEVELS = ('day', 'month')
+
+# Options of the set and setcompressed actions, sent as an optional last
+# field. With blind, the record replaces its address without reading it
+# first: names map to 256 bit addresses, so the sender asserts no other
+# name shares it
+SET_FLAGS = ('index', 'blind')
+
+# Shard indexes are 4 hex digits and 0xffff is the manifest
+MAX_SHARDS = 4096
+
+# Bound of the number of names deleted by one archive transaction
+MAX_ARCHIVE_NAMES = 256
+
+# Delimiters of the payload and state serializations, and the tag of the
+# compressed state entries
+NAME_FORBIDDEN = ('-', '|', ',', '\x00')
+
+# Payload contents are logged at most once per interval, truncated: a
+# payload may carry the readings of thousands of participants
+PAYLOAD_LOG_INTERVAL = 1.0
+PAYLOAD_LOG_LENGTH = 256
+
+_last_payload_log = 0.0
+_skipped_payload_logs = 0
+
+
+def _log_payload(payload):
+    global _last_payload_log, _skipped_payload_logs  # pylint: disable=global-statement
+    now = time.monotonic()
+    if now - _last_payload_log < PAYLOAD_LOG_INTERVAL:
+        _skipped_payload_logs += 1
+        return
+    LOGGER.debug(
+        'Payload of %d bytes (%d not logged since the last one): %r',
+        len(payload), _skipped_payload_logs, payload[:PAYLOAD_LOG_LENGTH])
+    _last_payload_log = now
+    _skipped_payload_logs = 0
+
+
+def validate_name(name):
+    """Checks that name can be serialized in a payload and in state.
+
+    Raises:
+        InvalidTransaction
+    """
+    if not name:
+        raise InvalidTransaction('Name is required')
+    for delimiter in NAME_FORBIDDEN:
+        if delimiter in name:
+            raise InvalidTransaction(
+                'Name can not contain {}: {}'.format(delimiter, name))
+
+
+def _count_values(values, what):
+    """Returns the number of comma-separated non-negative integers in values.
+
+    The check runs over the whole string at once rather than value by
+    value, which keeps it fast for lists of thousands of participants.
+    """
+    if not values:
+        raise InvalidTransaction('The {} is required'.format(what))
+    if values[0] == ',' or values[-1] == ',' or ',,' in values:
+        raise InvalidTransaction('Empty value in the {}'.format(what))
+    digits = values.replace(',', '')
+    if not (digits.isascii() and digits.isdigit()):
+        raise InvalidTransaction(
+            'The {} must only hold non-negative integers'.format(what))
+    return values.count(',') + 1
+
+
+def validate_record(name, listId, listConsumption):
+    """Checks a record of the set action, as serialized in the payload.
+
+    WeClient runs the same check before signing, so that a bad record is
+    rejected locally instead of invalidating the batch holding it.
+
+    Args:
+        name (str): The date and hour of the recorded consumption.
+        listId (str): The comma-separated ids of the participants.
+        listConsumption (str): The comma-separated consumptions.
+
+    Raises:
+        InvalidTransaction
+    """
+    validate_name(name)
+    ids = _count_values(listId, 'ID list')
+    consumptions = _count_values(
+        listConsumption, 'list of the consumption')
+    if ids != consumptions:
+        raise InvalidTransaction(
+            'The ID list has {} values but the list of the consumption '
+            'has {}'.format(ids, consumptions))
+
+
 class WePayload:
     def __init__(self,payload):
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            _log_payload(payload)
         try:
-            print('payload.decode() = ', payload.decode())
-            name, action, listId, listConsumption = payload.decode().split("-")
+            name, action, *args = payload.decode().split("-")
         except ValueError as e:
             raise InvalidTransaction("Invalid payload serialization") from e
-        if not listId:
-            raise InvalidTransaction('The ID list is required')
-        if not listConsumption:
-            raise InvalidTransaction('The list of the consumption is required')
+        validate_name(name)
         if not action:
             raise InvalidTransaction('Action is required')
-        if action not in ('set'):
+        if action not in ACTIONS:
             raise InvalidTransaction('Invalid action: {}'.format(action))
         self._name = name
         self._action = action
+        self._listId = None
+        self._listConsumption = None
+        self._level = None
+        self._members = None
+        self._shard = None
+        self._splits = None
+        self._flags = frozenset()
+        self._producers = None
+        self._entry = None
+
+        if action == 'set':
+            self._parse_set(args)
+        elif action == 'setcompressed':
+            self._parse_setcompressed(args)
+        elif action == 'rollup':
+            self._parse_rollup(args)
+        elif action == 'setshard':
+            self._parse_setshard(args)
+        elif action == 'manifest':
+            self._parse_manifest(args)
+        elif action == 'archive':
+            self._parse_archive(args)
+        elif action == 'settle':
+            self._parse_settle(args)
+
+    def _parse_flags(self, flags):
+        if len(flags) > 1:
+            raise InvalidTransaction("Invalid payload serialization")
+        if flags:
+            self._flags = frozenset(flags[0].split(","))
+            unknown = self._flags.difference(SET_FLAGS)
+            if unknown:
+                raise InvalidTransaction('Invalid set flags: {}'.format(
+                    ",".join(sorted(unknown))))
+
+    def _parse_set(self, args):
+        try:
+            listId, listConsumption, *flags = args
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        self._parse_flags(flags)
+        validate_record(self._name, listId, listConsumption)
+        self._listId = listId
+        self._listConsumption = listConsumption
+
+    def _parse_setcompressed(self, args):
+        # The record comes as the base64 of the compressed state entry
+        # which the validators store as it is
+        try:
+            entry, *flags = args
+            entry = base64.b64decode(entry, validate=True)
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        self._parse_flags(flags)
+        if entry[:1] != COMPRESSED_TAG:
+            raise InvalidTransaction('The record is not compressed')
+        try:
+            name, listId, listConsumption = decompress_entry(
+                entry, max_size=MAX_ENTRY_SIZE).decode().split("-")
+        except ValueError as e:
+            raise InvalidTransaction(
+                'Invalid compressed record: {}'.format(e)) from e
+        if name != self._name:
+            raise InvalidTransaction(
+                'The compressed record is the one of {}'.format(name))
+        validate_record(self._name, listId, listConsumption)
         self._listId = listId
         self._listConsumption = listConsumption
+        self._entry = entry
+
+    def _parse_rollup(self, args):
+        try:
+            level, members = args
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        if level not in ROLLUP_LEVELS:
+            raise InvalidTransaction('Invalid rollup level: {}'.format(level))
+        members = members.split(",")
+        if not all(members):
+            raise InvalidTransaction('The list of the members is required')
+        self._level = level
+        self._members = members
+
+    def _parse_splits(self, splits):
+        try:
+            splits = [int(split) for split in splits.split(",") if split]
+        except ValueError as e:
+            raise InvalidTransaction('Invalid shard splits') from e
+        if len(splits) >= MAX_SHARDS:
+            raise InvalidTransaction(
+                'At most {} shards are supported'.format(MAX_SHARDS))
+        if any(a >= b for a, b in zip(splits, splits[1:])):
+            raise InvalidTransaction('The shard splits must be increasing')
+        return splits
+
+    def _parse_setshard(self, args):
+        try:
+            shard, splits, listId, listConsumption = args
+            shard = int(shard)
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        self._splits = self._parse_splits(splits)
+        if not 0 <= shard <= len(self._splits):
+            raise InvalidTransaction('Invalid shard: {}'.format(shard))
+        self._shard = shard
+        self._parse_set([listId, listConsumption])
+
+    def _parse_manifest(self, args):
+        try:
+            splits, = args
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        self._splits = self._parse_splits(splits)
+
+    def _parse_archive(self, args):
+        # The name of an archive transaction is its cutoff
+        try:
+            members, = args
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        members = members.split(",")
+        if len(members) > MAX_ARCHIVE_NAMES:
+            raise InvalidTransaction(
+                'At most {} names can be archived at once'.format(
+                    MAX_ARCHIVE_NAMES))
+        for member in members:
+            validate_name(member)
+            if member >= self._name:
+                raise InvalidTransaction(
+                    '{} is not older than the cutoff {}'.format(
+                        member, self._name))
+        self._members = members
+
+    def _parse_settle(self, args):
+        try:
+            producers, = args
+            # No producer at all is a valid, if dull, hour
+            producers = [int(p) for p in producers.split(",") if p]
+        except ValueError as e:
+            raise InvalidTransaction("Invalid payload serialization") from e
+        self._producers = producers
 
     @staticmethod
     def from_bytes(payload):
@@ -49,10 +294,38 @@ class WePayload:
     def listConsumption(self):
         return self._listConsumption
 
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def members(self):
+        return self._members
+
+    @property
+    def producers(self):
+        return self._producers
+
+    @property
+    def flags(self):
+        return self._flags
+
+    @property
+    def entry(self):
+        return self._entry
+
+    @property
+    def shard(self):
+        return self._shard
+
+    @property
+    def splits(self):
+        return self._splits
+
     @property
     def action(self):
         return self._action
 
     @property
     def name(self):
-        return self._name
\ No newline at end of file
+        return self._name
@@ -14,12 +14,100 @@
 # -----------------------------------------------------------------------------
 
 import hashlib
+import zlib
 
 from sawtooth_sdk.processor.exceptions import InternalError
+from sawtooth_sdk.processor.exceptions import InvalidTransaction
 
 
 WE_NAMESPACE = hashlib.sha512('we'.encode("utf-8")).hexdigest()[0:6]
 
+# Compressed state entries are the tag, which no name starts with, the
+# method, then the compressed serialization
+COMPRESSED_TAG = b'\x00'
+COMPRESS_ZLIB = b'z'
+COMPRESS_ZDICT = b'd'
+
+# Only clients compress: the validators store the bytes they are sent, as
+# zlib builds do not all produce the same stream. The preset dictionary
+# is built from constants only, so every build decompresses with it
+COMPRESS_LEVEL = 6
+
+# Bound of a decompressed entry sent by a client
+MAX_ENTRY_SIZE = 16 * 1024 * 1024
+
+
+def _build_zdict(size=32768):
+    """Returns a zlib preset dictionary for sorted ID lists, which are
+    mostly runs of consecutive small integers.
+    """
+    ids = []
+    length = 0
+    participant = 1
+    while True:
+        value = str(participant)
+        if length + len(value) + 1 > size:
+            break
+        ids.append(value)
+        length += len(value) + 1
+        participant += 1
+    # zlib reaches the end of the dictionary with the shortest distances,
+    # keep the smallest ids there
+    return ",".join(reversed(ids)).encode()
+
+
+ZDICT = _build_zdict()
+
+
+def compress_entry(data, method=COMPRESS_ZDICT):
+    """Returns data in the tagged compressed format."""
+    if method == COMPRESS_ZDICT:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=ZDICT)
+    elif method == COMPRESS_ZLIB:
+        compressor = zlib.compressobj(COMPRESS_LEVEL)
+    else:
+        raise ValueError('Unknown compression method {!r}'.format(method))
+    return COMPRESSED_TAG + method + \
+        compressor.compress(data) + compressor.flush()
+
+
+def decompress_entry(data, max_size=None):
+    """Returns the serialization held by a state entry, decompressing
+    it when it is in the tagged format.
+
+    Args:
+        data (bytes): The state entry.
+        max_size (int): The size in bytes past which the decompressed
+            serialization is refused, None does not bound it.
+
+    Raises:
+        ValueError: The entry is tagged but can not be decompressed, is
+            not a single complete stream or exceeds max_size.
+    """
+    if data[:1] != COMPRESSED_TAG:
+        return data
+    method = data[1:2]
+    try:
+        if method == COMPRESS_ZDICT:
+            decompressor = zlib.decompressobj(zdict=ZDICT)
+        elif method == COMPRESS_ZLIB:
+            decompressor = zlib.decompressobj()
+        else:
+            raise ValueError(
+                'Unknown compression method {!r}'.format(method))
+        if max_size is None:
+            serialization = decompressor.decompress(data[2:])
+        else:
+            serialization = decompressor.decompress(data[2:], max_size + 1)
+            if len(serialization) > max_size:
+                raise ValueError(
+                    'Compressed entry exceeds {} bytes'.format(max_size))
+    except zlib.error as e:
+        raise ValueError('Corrupted compressed entry') from e
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError('Corrupted compressed entry')
+    return serialization
+
 
 
 
@@ -27,6 +115,51 @@ def _make_we_address(name):
     return WE_NAMESPACE + \
         hashlib.sha512(name.encode('utf-8')).hexdigest()[:64]
 
+
+def _make_settlement_address(name):
+    return WE_NAMESPACE + \
+        hashlib.sha512('settle-{}'.format(name).encode('utf-8')).hexdigest()[:64]
+
+
+def _make_rollup_address(name):
+    # '-' can not appear in a name, so this never matches an energy address
+    return WE_NAMESPACE + \
+        hashlib.sha512('rollup-{}'.format(name).encode('utf-8')).hexdigest()[:64]
+
+MANIFEST_SHARD = 0xffff
+
+
+def _make_shard_prefix(name):
+    return WE_NAMESPACE + \
+        hashlib.sha512('shard-{}'.format(name).encode('utf-8')).hexdigest()[:60]
+
+
+def _make_shard_address(name, shard):
+    """The shards of a name and its manifest (shard MANIFEST_SHARD) share
+    one prefix, so they can be listed with a single state query.
+    """
+    return _make_shard_prefix(name) + '{:04x}'.format(shard)
+
+
+# Names per page of a participant index
+INDEX_PAGE_SIZE = 256
+
+INDEX_HEAD = 0xffff
+
+
+def _make_index_prefix(participant):
+    return WE_NAMESPACE + \
+        hashlib.sha512('index-{}'.format(participant).encode('utf-8')).hexdigest()[:60]
+
+
+def _make_index_address(participant, page):
+    """The pages of the index of a participant and its head (page
+    INDEX_HEAD) share one prefix, which a set transaction declares as
+    input and output.
+    """
+    return _make_index_prefix(participant) + '{:04x}'.format(page)
+
+
 class Energy:
     def __init__(self, name, listId, listConsumption):
         self.name = name
@@ -34,6 +167,75 @@ class Energy:
         self.listConsumption = listConsumption
 
 
+class Summary:
+    """Totals of a day (over its hourly energies) or of a month (over its
+    daily summaries).
+    """
+
+    def __init__(self, name, listId, listTotal, total, peakName,
+                 peakConsumption, count):
+        self.name = name
+        self.listId = listId
+        self.listTotal = listTotal
+        self.total = total
+        self.peakName = peakName
+        self.peakConsumption = peakConsumption
+        self.count = count
+
+    def serialize(self):
+        return "-".join([
+            self.name,
+            ",".join(str(i) for i in self.listId),
+            ",".join(str(t) for t in self.listTotal),
+            str(self.total),
+            self.peakName,
+            str(self.peakConsumption),
+            str(self.count)]).encode()
+
+    @staticmethod
+    def deserialize(data):
+        try:
+            name, listId, listTotal, total, peakName, peakConsumption, \
+                count = data.decode().split("-")
+            return Summary(
+                name=name,
+                listId=[int(i) for i in listId.split(",")],
+                listTotal=[int(t) for t in listTotal.split(",")],
+                total=int(total),
+                peakName=peakName,
+                peakConsumption=int(peakConsumption),
+                count=int(count))
+        except ValueError as e:
+            raise InternalError("Failed to deserialize summary data") from e
+
+
+class Settlement:
+    """The netting of an hour between its producers and its consumers.
+
+    For each participant, listLocal is the energy received from (for a
+    consumer) or delivered to (for a producer) the community, and listGrid
+    what is left to import from or export to the grid.
+    """
+
+    def __init__(self, name, listId, producers, listLocal, listGrid,
+                 communityImport, communityExport):
+        self.name = name
+        self.listId = listId
+        self.producers = producers
+        self.listLocal = listLocal
+        self.listGrid = listGrid
+        self.communityImport = communityImport
+        self.communityExport = communityExport
+
+    def serialize(self):
+        return "-".join([
+            self.name,
+            ",".join(str(i) for i in self.listId),
+            ",".join(str(p) for p in self.producers),
+            ",".join(str(v) for v in self.listLocal),
+            ",".join(str(v) for v in self.listGrid),
+            str(self.communityImport),
+            str(self.communityExport)]).encode()
 
 
 class WeState:
@@ -42,14 +244,14 @@ class WeState:
     def __init__(self,context):
         self._context = context
         self._address_cache = {}
-        print('we_state: init ok')
 
     def _deserialize(self, data):
         """Take bytes stored in state and deserialize them into Python
         Energy objects.
 
         Args:
-            data (bytes): The UTF-8 encoded string stored in state.
+            data (bytes): The UTF-8 encoded string stored in state,
+                possibly compressed.
 
         Returns:
             (dict): energy name (str) keys, Energy values.
@@ -57,6 +259,7 @@ class WeState:
 
         energies = {}
         try:
+            data = decompress_entry(data)
             for energy in data.decode().split("|"):
                 name, listId, listConsumption = energy.split("-")
 
@@ -120,21 +323,53 @@ class WeState:
             {address: state_data},
             timeout=self.TIMEOUT)
     
-    def set_energy(self, energy_name, energy):
+    def set_energy(self, energy_name, energy, blind=False):
         """Store the energy in the validator state.
 
         Args:
             energy_name (str): The name.
             energy (Energy): The information specifying the current energy.
+            blind (bool): Write the energy as the only entry of its address
+                without reading it, dropping any colliding name.
         """
 
+        if blind:
+            self._store_energy(energy_name, energies={energy_name: energy})
+            return
+
         energies = self._load_energy(energy_name=energy_name)
 
         energies[energy_name] = energy
-        print("set_energy in we_state")
 
         self._store_energy(energy_name, energies=energies)
 
+    def set_compressed_energy(self, energy_name, data, blind=False):
+        """Store the compressed entry sent by a client as it is.
+
+        The entry only holds energy_name, so no other name may share its
+        address.
+
+        Args:
+            energy_name (str): The name.
+            data (bytes): The compressed entry, checked by WePayload.
+            blind (bool): Write the entry without reading the address,
+                dropping any colliding name.
+
+        Raises:
+            InvalidTransaction: Another name is stored at the address.
+        """
+        if not blind:
+            colliding = set(self._load_energy(energy_name))
+            colliding.discard(energy_name)
+            if colliding:
+                raise InvalidTransaction(
+                    'Can not store {} compressed beside {}'.format(
+                        energy_name, ",".join(sorted(colliding))))
+
+        address = _make_we_address(energy_name)
+        self._address_cache[address] = data
+        self._context.set_state({address: data}, timeout=self.TIMEOUT)
+
     def get_energy(self, energy_name):
         """Get the energy associated with energy_name.
 
@@ -144,5 +379,258 @@ class WeState:
         Returns:
             (Energy): All the information specifying a energy.
         """
-        print("get_energy in we_state")
-        return self._load_energy(energy_name=energy_name).get(energy_name)
\ No newline at end of file
+        return self._load_energy(energy_name=energy_name).get(energy_name)
+
+    def get_energies(self, energy_names):
+        """Get the energies of several names with a single state read.
+
+        Args:
+            energy_names (list of str): The names.
+
+        Returns:
+            (dict): energy name (str) keys, Energy values, for the names
+                found in state.
+        """
+        addresses = {}
+        for energy_name in energy_names:
+            address = _make_we_address(energy_name)
+            addresses.setdefault(address, []).append(energy_name)
+
+        missing = [a for a in addresses if a not in self._address_cache]
+        if missing:
+            for address in missing:
+                self._address_cache[address] = None
+            for entry in self._context.get_state(
+                    missing, timeout=self.TIMEOUT):
+                self._address_cache[entry.address] = entry.data
+
+        found = {}
+        for address, names in addresses.items():
+            if not self._address_cache[address]:
+                continue
+            energies = self._deserialize(self._address_cache[address])
+            for energy_name in names:
+                if energy_name in energies:
+                    found[energy_name] = energies[energy_name]
+        return found
+
+    def get_summaries(self, summary_names):
+        """Get the summaries of several names with a single state read.
+
+        Args:
+            summary_names (list of str): The names of the summaries.
+
+        Returns:
+            (dict): summary name (str) keys, Summary values, for the names
+                found in state.
+        """
+        addresses = {
+            _make_rollup_address(name): name for name in summary_names}
+        found = {}
+        for entry in self._context.get_state(
+                list(addresses), timeout=self.TIMEOUT):
+            if not entry.data:
+                continue
+            summary = Summary.deserialize(entry.data)
+            if summary.name == addresses[entry.address]:
+                found[summary.name] = summary
+        return found
+
+    def set_summary(self, summary):
+        """Store a summary at the rollup address of its name.
+
+        Args:
+            summary (Summary): The totals of a day or of a month.
+        """
+        self._context.set_state(
+            {_make_rollup_address(summary.name): summary.serialize()},
+            timeout=self.TIMEOUT)
+
+    def set_shard(self, shard, energy):
+        """Store one participant range of a sharded energy.
+
+        A shard address only ever holds its own shard, so it is written
+        without being read first.
+
+        Args:
+            shard (int): The index of the shard.
+            energy (Energy): The participants of the shard.
+        """
+        self._context.set_state(
+            {_make_shard_address(energy.name, shard):
+                self._serialize({energy.name: energy})},
+            timeout=self.TIMEOUT)
+
+    def get_manifest(self, energy_name):
+        """Get the shard splits of a sharded energy.
+
+        Args:
+            energy_name (str): The name.
+
+        Returns:
+            (list of int): The first participant id of every shard but the
+                first one, None when the name is not sharded.
+        """
+        state_entries = self._context.get_state(
+            [_make_shard_address(energy_name, MANIFEST_SHARD)],
+            timeout=self.TIMEOUT)
+        if not state_entries or not state_entries[0].data:
+            return None
+        try:
+            _, _, splits = state_entries[0].data.decode().split("-")
+            return [int(split) for split in splits.split(",") if split]
+        except ValueError as e:
+            raise InternalError("Failed to deserialize manifest") from e
+
+    def set_manifest(self, energy_name, splits):
+        """Store the manifest of a sharded energy, deleting the shards
+        of a previous manifest past the new number of shards.
+
+        Args:
+            energy_name (str): The name.
+            splits (list of int): The first participant id of every shard
+                but the first one.
+        """
+        previous = self.get_manifest(energy_name)
+        if previous is not None and len(previous) > len(splits):
+            self._context.delete_state(
+                [_make_shard_address(energy_name, shard)
+                 for shard in range(len(splits) + 1, len(previous) + 1)],
+                timeout=self.TIMEOUT)
+
+        data = "-".join([
+            energy_name,
+            str(len(splits) + 1),
+            ",".join(str(split) for split in splits)]).encode()
+        self._context.set_state(
+            {_make_shard_address(energy_name, MANIFEST_SHARD): data},
+            timeout=self.TIMEOUT)
+
+    def index_participants(self, energy_name, participants):
+        """Append energy_name to the index of each participant.
+
+        The index of a participant is a list of pages of at most
+        INDEX_PAGE_SIZE names and a head holding the number of the last
+        page and its length. Heads and last pages are each read with a
+        single state call and everything is written with a single one.
+
+        Args:
+            energy_name (str): The name.
+            participants (iterable of int): The ids of the participants.
+
+        Returns:
+            (int): The number of addresses written.
+        """
+        participants = sorted(set(participants))
+        heads = {
+            _make_index_address(participant, INDEX_HEAD): participant
+            for participant in participants}
+        positions = {participant: (0, 0) for participant in participants}
+        for entry in self._context.get_state(
+                list(heads), timeout=self.TIMEOUT):
+            if entry.data:
+                page, count = entry.data.decode().split(",")
+                positions[heads[entry.address]] = (int(page), int(count))
+
+        pages = {
+            _make_index_address(participant, page): participant
+            for participant, (page, count) in positions.items() if count}
+        names = {participant: [] for participant in participants}
+        if pages:
+            for entry in self._context.get_state(
+                    list(pages), timeout=self.TIMEOUT):
+                if entry.data:
+                    names[pages[entry.address]] = \
+                        entry.data.decode().split(",")
+
+        updates = {}
+        for participant in participants:
+            page, count = positions[participant]
+            page_names = names[participant]
+            if energy_name in page_names:
+                continue
+            if count >= INDEX_PAGE_SIZE:
+                page, page_names = page + 1, []
+            page_names.append(energy_name)
+            updates[_make_index_address(participant, page)] = \
+                ",".join(page_names).encode()
+            updates[_make_index_address(participant, INDEX_HEAD)] = \
+                "{},{}".format(page, len(page_names)).encode()
+
+        if updates:
+            self._context.set_state(updates, timeout=self.TIMEOUT)
+        return len(updates)
+
+    def delete_energies(self, energy_names):
+        """Remove the energies of several names from state.
+
+        The addresses are read with a single call; the ones left empty are
+        deleted and the ones still holding colliding names are rewritten.
+        The manifests are read with a second call, and the shards and
+        manifest of every sharded name found are deleted. The settlements
+        of the names are deleted as well.
+
+        Args:
+            energy_names (list of str): The names.
+
+        Returns:
+            (int): The number of names found and removed.
+        """
+        buckets = {}
+        for energy_name in energy_names:
+            buckets.setdefault(
+                _make_we_address(energy_name), []).append(energy_name)
+
+        removed = 0
+        updates = {}
+        deletes = []
+        for entry in self._context.get_state(
+                list(buckets), timeout=self.TIMEOUT):
+            if not entry.data:
+                continue
+            energies = self._deserialize(entry.data)
+            for energy_name in buckets[entry.address]:
+                if energies.pop(energy_name, None) is not None:
+                    removed += 1
+            if energies:
+                updates[entry.address] = self._serialize(energies)
+            else:
+                deletes.append(entry.address)
+
+        manifests = {
+            _make_shard_address(energy_name, MANIFEST_SHARD): energy_name
+            for energy_name in energy_names}
+        for entry in self._context.get_state(
+                list(manifests), timeout=self.TIMEOUT):
+            if not entry.data:
+                continue
+            energy_name = manifests[entry.address]
+            _, count, _ = entry.data.decode().split("-")
+            deletes.extend(
+                _make_shard_address(energy_name, shard)
+                for shard in range(int(count)))
+            deletes.append(entry.address)
+            removed += 1
+
+        deletes.extend(
+            _make_settlement_address(energy_name)
+            for energy_name in energy_names)
+
+        for address in buckets:
+            self._address_cache[address] = updates.get(address)
+        if updates:
+            self._context.set_state(updates, timeout=self.TIMEOUT)
+        if deletes:
+            self._context.delete_state(deletes, timeout=self.TIMEOUT)
+        return removed
+
+    def set_settlement(self, settlement):
+        """Store a settlement beside the hourly record it nets.
+
+        Args:
+            settlement (Settlement): The netting of the hour.
+        """
+        self._context.set_state(
+            {_make_settlement_address(settlement.name):
+                settlement.serialize()},
+            timeout=self.TIMEOUT)
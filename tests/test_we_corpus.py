@@ -0,0 +1,73 @@
+# Copyright 2017 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""A small corpus written with write_corpus and read back."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sawtooth_we.we_corpus import CorpusReader
+from sawtooth_we.we_corpus import synthetic_records
+from sawtooth_we.we_corpus import write_corpus
+
+from sawtooth_sdk.protobuf.batch_pb2 import Batch
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+
+
+class TestCorpus(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'corpus.bin')
+        self.records = list(synthetic_records(10, 5, seed=0))
+        self.written = write_corpus(
+            self.filename, self.records, batch_size=3, workers=2,
+            chunk_size=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_batches_read_back(self):
+        self.assertEqual(4, self.written)
+
+        names = []
+        with CorpusReader(self.filename) as reader:
+            for data in reader.iter_batches():
+                batch = Batch()
+                batch.ParseFromString(bytes(data))
+                self.assertTrue(batch.header_signature)
+                names.extend(
+                    txn.payload.decode().split("-")[0]
+                    for txn in batch.transactions)
+        self.assertEqual([name for name, _, _ in self.records], names)
+
+    def test_batch_lists_read_back(self):
+        with CorpusReader(self.filename) as reader:
+            batch_lists = list(reader.iter_batch_lists(batches_per_list=3))
+        self.assertEqual(2, len(batch_lists))
+
+        counts = []
+        for data in batch_lists:
+            batch_list = BatchList()
+            batch_list.ParseFromString(data)
+            counts.append([
+                len(batch.transactions) for batch in batch_list.batches])
+        self.assertEqual([[3, 3, 3], [1]], counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""ZmqTransport against a ROUTER socket standing in for the validator."""
+
+import concurrent.futures
+import sys
+import threading
+import unittest
+
+import zmq
+
+from sawtooth_we.we_exceptions import WeException
+from sawtooth_we.we_zmq import MAX_STATUS_WAIT
+from sawtooth_we.we_zmq import ZmqTransport
+
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatus
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatusRequest
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatusResponse
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchSubmitResponse
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateGetRequest
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateGetResponse
+from sawtooth_sdk.protobuf.validator_pb2 import Message
+
+
+class FakeValidator:
+    """Answers client requests on a ROUTER socket.
+
+    The requests are held until hold of them arrived, then answered in
+    the reverse order, so the responses come back out of order.
+    """
+
+    def __init__(self, hold=1):
+        self.hold = hold
+        self.requests = []
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.ROUTER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        port = self._socket.bind_to_random_port('tcp://127.0.0.1')
+        self.url = 'tcp://127.0.0.1:{}'.format(port)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._socket.close()
+        self._context.term()
+
+    def _run(self):
+        held = []
+        while not self._stop.is_set():
+            if not self._socket.poll(50):
+                continue
+            identity, data = self._socket.recv_multipart()
+            message = Message()
+            message.ParseFromString(data)
+            self.requests.append(message)
+            held.append((identity, message))
+            if len(held) < self.hold:
+                continue
+            for identity, message in reversed(held):
+                message_type, content = self._answer(message)
+                self._socket.send_multipart([identity, Message(
+                    correlation_id=message.correlation_id,
+                    message_type=message_type,
+                    content=content.SerializeToString(),
+                ).SerializeToString()])
+            held = []
+
+    @staticmethod
+    def _answer(message):
+        if message.message_type == Message.CLIENT_BATCH_SUBMIT_REQUEST:
+            return (
+                Message.CLIENT_BATCH_SUBMIT_RESPONSE,
+                ClientBatchSubmitResponse(
+                    status=ClientBatchSubmitResponse.OK))
+        if message.message_type == Message.CLIENT_BATCH_STATUS_REQUEST:
+            request = ClientBatchStatusRequest()
+            request.ParseFromString(message.content)
+            return (
+                Message.CLIENT_BATCH_STATUS_RESPONSE,
+                ClientBatchStatusResponse(
+                    status=ClientBatchStatusResponse.OK,
+                    batch_statuses=[
+                        ClientBatchStatus(
+                            batch_id=batch_id,
+                            status=ClientBatchStatus.COMMITTED)
+                        for batch_id in request.batch_ids]))
+        if message.message_type == Message.CLIENT_STATE_GET_REQUEST:
+            request = ClientStateGetRequest()
+            request.ParseFromString(message.content)
+            if request.address.startswith('00'):
+                return (
+                    Message.CLIENT_STATE_GET_RESPONSE,
+                    ClientStateGetResponse(
+                        status=ClientStateGetResponse.NO_RESOURCE))
+            return (
+                Message.CLIENT_STATE_GET_RESPONSE,
+                ClientStateGetResponse(
+                    status=ClientStateGetResponse.OK,
+                    value=request.address.encode()))
+        raise AssertionError(
+            'Unexpected message type {}'.format(message.message_type))
+
+
+class TestZmqTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = None
+        self.transport = None
+
+    def tearDown(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.validator is not None:
+            self.validator.close()
+
+    def _connect(self, hold=1):
+        self.validator = FakeValidator(hold=hold)
+        self.transport = ZmqTransport(self.validator.url, timeout=10)
+
+    def test_submit_status_and_state(self):
+        self._connect()
+        self.assertIn(
+            self.validator.url,
+            self.transport.submit_batches(
+                BatchList().SerializeToString()))
+        statuses = self.transport.batch_statuses(['a', 'b'], 0)
+        self.assertEqual(
+            ['COMMITTED', 'COMMITTED'],
+            [statuses[batch_id]['status'] for batch_id in ('a', 'b')])
+        self.assertEqual(b'11aa', self.transport.get_state('11aa'))
+        self.assertIsNone(self.transport.get_state('00aa'))
+
+    def test_wait_forever_is_clamped(self):
+        self._connect()
+        statuses = self.transport.batch_statuses(['a'], sys.maxsize)
+        self.assertEqual('COMMITTED', statuses['a']['status'])
+
+        request = ClientBatchStatusRequest()
+        request.ParseFromString(self.validator.requests[-1].content)
+        self.assertTrue(request.wait)
+        self.assertEqual(MAX_STATUS_WAIT, request.timeout)
+
+    def test_out_of_order_responses(self):
+        addresses = ['{:02x}aa'.format(i) for i in range(1, 8)]
+        self._connect(hold=len(addresses) + 2)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(addresses) + 2) as executor:
+            states = {
+                address: executor.submit(self.transport.get_state, address)
+                for address in addresses}
+            submitted = executor.submit(
+                self.transport.submit_batches,
+                BatchList().SerializeToString())
+            statuses = executor.submit(
+                self.transport.batch_statuses, ['a'], 1)
+
+            for address, future in states.items():
+                self.assertEqual(address.encode(), future.result())
+            self.assertIn(self.validator.url, submitted.result())
+            self.assertEqual('COMMITTED', statuses.result()['a']['status'])
+
+    def test_unreachable_validator_times_out(self):
+        # Nothing listens there, the DEALER socket just queues the request
+        self.transport = ZmqTransport('tcp://127.0.0.1:1', timeout=0.2)
+        with self.assertRaises(WeException):
+            self.transport.get_state('11aa')
+
+    def test_closed_transport_refuses_requests(self):
+        self._connect()
+        self.transport.close()
+        with self.assertRaises(WeException):
+            self.transport.get_state('11aa')
+        self.transport = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,16 +17,23 @@ from __future__ import print_function
 
 import argparse
 import getpass
+import itertools
+import json
 import logging
 import os
+import re
 import traceback
 import sys
 import pkg_resources
+import toml
 
 from colorlog import ColoredFormatter
 
 from sawtooth_we.we_client import WeClient
 from sawtooth_we.we_exceptions import WeException
+from sawtooth_we.we_serve import WeDaemon
+from sawtooth_we.we_serve import connect_daemon
+from sawtooth_we.we_tracing import NdjsonSink
 
 
 DISTRIBUTION_NAME = 'sawtooth-we'
@@ -34,6 +41,11 @@ DISTRIBUTION_NAME = 'sawtooth-we'
 
 DEFAULT_URL = 'http://127.0.0.1:8008'
 
+CONFIG_FILE = 'we.toml'
+
+CONFIG_KEYS = ('url', 'routing', 'timeout', 'health_interval', 'outbox',
+               'zmq_url', 'compress_threshold')
+
 
 def create_console_handler(verbose_level):
     clog = logging.StreamHandler()
@@ -93,6 +105,33 @@ def add_set_parser(subparsers, parent_parser):
         nargs = '+',
         help='specify the consummtion of each participant separated by a space')
 
+    parser.add_argument(
+        '-shards',
+        type=int,
+        help='split the record by participant id range into this number of shards')
+
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help='also add the name to the on-chain index of each participant')
+
+    parser.add_argument(
+        '--blind',
+        action='store_true',
+        help='write the record without reading its state entry first')
+
+    parser.add_argument(
+        '--trace-file',
+        type=str,
+        help='append the latency trace of the submission to this NDJSON file')
+
+    parser.add_argument(
+        '--wait',
+        nargs='?',
+        const=sys.maxsize,
+        type=int,
+        help='set time, in seconds, to wait for the transaction to commit')
+
 
 def add_get_parser(subparsers, parent_parser):
     parser = subparsers.add_parser(
@@ -104,7 +143,200 @@ def add_get_parser(subparsers, parent_parser):
     parser.add_argument(
         '-name',
         type=str,
-        help='specify the name of the energy community')
+        nargs='+',
+        help='specify the name of the energy community, several names are fetched in parallel')
+
+    parser.add_argument(
+        '-range',
+        type=str,
+        nargs=2,
+        metavar=('FIRST', 'LAST'),
+        help='fetch every name from FIRST to LAST, which only differ by their trailing number (e.g. 2021_01_01_00 2021_01_01_23)')
+
+    parser.add_argument(
+        '-concurrency',
+        type=int,
+        default=16,
+        help='maximum number of requests in flight when fetching several names')
+
+    parser.add_argument(
+        '--summary',
+        action='store_true',
+        help='get the daily or monthly summary stored under the name')
+
+    parser.add_argument(
+        '--settlement',
+        action='store_true',
+        help='get the settlement of the hour stored under the name')
+
+
+def add_settle_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'settle',
+        help='function to store the netting of an hour',
+        description='Nets the consumption of an hour against the production of its producers, pro-rata, and stores the result beside the record',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '-name',
+        type=str,
+        help='specify the date and hour of the record to settle')
+
+    parser.add_argument(
+        '-producers',
+        type=int,
+        nargs='*',
+        default=[],
+        help='specify the Id of the producers separated by a space, the other participants are consumers')
+
+    parser.add_argument(
+        '--wait',
+        nargs='?',
+        const=sys.maxsize,
+        type=int,
+        help='set time, in seconds, to wait for the transaction to commit')
+
+
+def add_import_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'import',
+        help='function to put many records on the BlockChain',
+        description='Sends the records of a file, one per line: the name, then the comma-separated Ids, then the comma-separated consumptions, separated by spaces',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '-file',
+        type=str,
+        help='specify the file holding the records')
+
+    parser.add_argument(
+        '-batchSize',
+        type=int,
+        default=100,
+        help='specify the number of records sent in one batch')
+
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help='also add the names to the on-chain index of each participant')
+
+    parser.add_argument(
+        '--blind',
+        action='store_true',
+        help='write the records without reading their state entries first')
+
+    parser.add_argument(
+        '--wait',
+        nargs='?',
+        const=sys.maxsize,
+        type=int,
+        help='set time, in seconds, to wait for each batch to commit')
+
+
+def add_serve_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'serve',
+        help='function to run a local daemon sending the records of set and import',
+        description='Keeps the key, the connections and a coalescing submitter ready, and accepts records on a Unix socket; set and import forward their records to it while it runs with the same URLs, routing and config',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '--delay',
+        type=float,
+        default=0.05,
+        help='set the time, in seconds, a record waits at most to be sent with others')
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=256,
+        help='set the number of records sent at most in one request')
+
+
+def add_archive_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'archive',
+        help='function to delete old hourly records from the BlockChain state',
+        description='Exports the records older than the cutoff to a local file, checks the export, then deletes them from state',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '-cutoff',
+        type=str,
+        required=True,
+        help='only names sorting before the cutoff are archived (e.g. 2021_01_01_00)')
+
+    parser.add_argument(
+        '-name',
+        type=str,
+        nargs='+',
+        help='specify the names to archive')
+
+    parser.add_argument(
+        '-range',
+        type=str,
+        nargs=2,
+        metavar=('FIRST', 'LAST'),
+        help='archive every name from FIRST to LAST, which only differ by their trailing number')
+
+    parser.add_argument(
+        '-export',
+        type=str,
+        required=True,
+        help='specify the NDJSON file receiving the archived records')
+
+    parser.add_argument(
+        '--wait',
+        nargs='?',
+        const=sys.maxsize,
+        type=int,
+        help='set time, in seconds, to wait for the deletions to commit')
+
+
+def add_history_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'history',
+        help='function to list the names a participant appears in',
+        description='Reads the on-chain index of a participant, filled by set --index',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '-participant',
+        type=int,
+        help='specify the Id of the consummer/producer')
+
+
+def add_rollup_parser(subparsers, parent_parser):
+    parser = subparsers.add_parser(
+        'rollup',
+        help='function to store the summary of a day or of a month',
+        description='Sums the hourly records of a day, or the daily summaries of a month, into one summary',
+        parents=[parent_parser])
+
+    parser.add_argument(
+        '-name',
+        type=str,
+        help='specify the name of the summary (the day or the month)')
+
+    parser.add_argument(
+        '-level',
+        type=str,
+        choices=['day', 'month'],
+        default='day',
+        help='day sums hourly records, month sums daily summaries')
+
+    parser.add_argument(
+        '-members',
+        type=str,
+        nargs='+',
+        help='specify the names of the hours (or days) separated by a space')
+
+    parser.add_argument(
+        '--wait',
+        nargs='?',
+        const=sys.maxsize,
+        type=int,
+        help='set time, in seconds, to wait for the transaction to commit')
 
 
 
@@ -119,6 +351,23 @@ def create_parent_parser(prog_name):
         action='count',
         help='enable more verbose output')
 
+    parent_parser.add_argument(
+        '--url',
+        type=str,
+        nargs='+',
+        help='specify the URL of the REST API, several URLs (or a comma-separated list) spread the requests over several nodes')
+
+    parent_parser.add_argument(
+        '--routing',
+        type=str,
+        choices=['round-robin', 'least-latency'],
+        help='how requests are spread over several URLs')
+
+    parent_parser.add_argument(
+        '--socket',
+        type=str,
+        help='specify the Unix socket of the we serve daemon (default ~/.sawtooth/we.sock)')
+
     try:
         version = pkg_resources.get_distribution(DISTRIBUTION_NAME).version
     except pkg_resources.DistributionNotFound:
@@ -147,6 +396,12 @@ def create_parser(prog_name):
 
     add_set_parser(subparsers, parent_parser)
     add_get_parser(subparsers, parent_parser)
+    add_rollup_parser(subparsers, parent_parser)
+    add_settle_parser(subparsers, parent_parser)
+    add_history_parser(subparsers, parent_parser)
+    add_import_parser(subparsers, parent_parser)
+    add_archive_parser(subparsers, parent_parser)
+    add_serve_parser(subparsers, parent_parser)
 
     return parser
 
@@ -159,24 +414,342 @@ def do_set(args):
     listConsumption = args.listConsumption
     name = args.name
 
-    url = _get_url(args)
+    if not args.shards and args.trace_file is None:
+        daemon = _connect_daemon(args)
+        if daemon is not None:
+            with daemon:
+                for _, ok, message in daemon.set_many(
+                        [(name, listId, listConsumption)], wait=args.wait,
+                        index=args.index, blind=args.blind):
+                    if not ok:
+                        raise WeException(message)
+                    print("Response: {}".format(message))
+            return
+
     keyfile = _get_keyfile(args)
-    client = WeClient(base_url=url, keyfile=keyfile)
-    response = client.set(name, listId, listConsumption)
+    trace_sink = None
+    if args.trace_file is not None:
+        trace_sink = NdjsonSink(args.trace_file)
+    client = _create_client(args, keyfile=keyfile, trace_sink=trace_sink)
+    try:
+        if args.shards:
+            response = client.set_sharded(
+                name, listId, listConsumption, args.shards, wait=args.wait)
+        else:
+            response = client.set(
+                name, listId, listConsumption, wait=args.wait,
+                index=args.index, blind=args.blind)
+    finally:
+        if trace_sink is not None:
+            trace_sink.close()
     print("Response: {}".format(response))
 
 
 def do_get(args):
-    url = _get_url(args)
+    client = _create_client(args)
+    names = list(args.name or [])
+    if args.range is not None:
+        names.extend(_expand_name_range(*args.range))
+    if not names:
+        raise WeException("a name or a range of names is required")
+
+    if args.summary or args.settlement:
+        for name in names:
+            if args.summary:
+                data = client.get_summary(name)
+            else:
+                data = client.get_settlement(name)
+            print("Response : ", data.decode("utf-8"))
+    elif len(names) == 1:
+        data = client.get(names[0])
+        print("Response : ", data.decode("utf-8"))
+    else:
+        for name, energy in client.get_many(
+                names, max_concurrency=args.concurrency):
+            if energy is None:
+                print("{} : not part of the BlockChain".format(name))
+            else:
+                print("{} : {}-{}".format(
+                    name, energy.listId, energy.listConsumption))
+
+
+def do_settle(args):
+    keyfile = _get_keyfile(args)
+    client = _create_client(args, keyfile=keyfile)
+    response = client.settle(args.name, args.producers, wait=args.wait)
+    print("Response: {}".format(response))
 
-    client = WeClient(base_url=url, keyfile=None)
-    data = client.get(args.name)
-    print("Response : ", data.decode("utf-8"))
+
+def do_rollup(args):
+    keyfile = _get_keyfile(args)
+    client = _create_client(args, keyfile=keyfile)
+    response = client.rollup(
+        args.name, args.members, level=args.level, wait=args.wait)
+    print("Response: {}".format(response))
 
     
     
 
-def _get_url(args):
+def _read_records(filename):
+    try:
+        with open(filename) as fd:
+            for number, line in enumerate(fd, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    name, listId, listConsumption = line.split()
+                    yield (
+                        name,
+                        [int(i) for i in listId.split(",")],
+                        [int(c) for c in listConsumption.split(",")])
+                except ValueError as err:
+                    raise WeException("{}:{}: invalid record: {}".format(
+                        filename, number, line.strip())) from err
+    except OSError as err:
+        raise WeException(
+            "Failed to read {}: {}".format(filename, str(err))) from err
+
+
+def _import_through_daemon(daemon, args):
+    sent = 0
+    with daemon:
+        for name, ok, message in daemon.set_many(
+                _read_records(args.file), wait=args.wait, index=args.index,
+                blind=args.blind, window=args.batchSize):
+            if ok:
+                sent += 1
+            else:
+                print("Rejected {}: {}".format(name, message), file=sys.stderr)
+    print("Sent {} records".format(sent))
+
+
+def do_import(args):
+    daemon = _connect_daemon(args)
+    if daemon is not None:
+        _import_through_daemon(daemon, args)
+        return
+
+    keyfile = _get_keyfile(args)
+    client = _create_client(args, keyfile=keyfile)
+
+    sent = 0
+    records = _read_records(args.file)
+    while True:
+        batch = list(itertools.islice(records, args.batchSize))
+        if not batch:
+            break
+        result = client.set_many(
+            batch, wait=args.wait, index=args.index, blind=args.blind)
+        for name, reason in result.rejected:
+            print("Rejected {}: {}".format(name, reason), file=sys.stderr)
+        for name in result.pending:
+            print("Pending {}".format(name), file=sys.stderr)
+        sent += len(batch) - len(result.rejected)
+    print("Sent {} records".format(sent))
+
+
+def do_serve(args):
+    keyfile = _get_keyfile(args)
+    client = _create_client(
+        args, keyfile=keyfile, outbox=True, coalesce_delay=args.delay,
+        coalesce_size=args.batch_size)
+    daemon = WeDaemon(client, path=args.socket)
+    try:
+        daemon.serve_forever()
+    finally:
+        client.close()
+
+
+def _export_energies(energies, filename):
+    """Writes the energies to filename, one JSON object per line, and
+    flushes them to disk.
+    """
+    with open(filename, 'x') as fd:
+        for energy in energies:
+            fd.write(json.dumps({
+                'name': energy.name,
+                'listId': energy.listId,
+                'listConsumption': energy.listConsumption,
+            }, sort_keys=True) + '\n')
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def _verify_export(energies, filename):
+    """Reads filename back and checks that it holds exactly energies."""
+    expected = {
+        energy.name: (energy.listId, energy.listConsumption)
+        for energy in energies}
+    exported = {}
+    with open(filename) as fd:
+        for line in fd:
+            record = json.loads(line)
+            exported[record['name']] = (
+                record['listId'], record['listConsumption'])
+    if exported != expected:
+        raise WeException(
+            "the export {} does not match the records, nothing was "
+            "archived".format(filename))
+
+
+def do_archive(args):
+    names = list(args.name or [])
+    if args.range is not None:
+        names.extend(_expand_name_range(*args.range))
+    names = [name for name in names if name < args.cutoff]
+    if not names:
+        raise WeException("no name older than the cutoff to archive")
+
+    keyfile = _get_keyfile(args)
+    client = _create_client(args, keyfile=keyfile)
+
+    energies = [
+        energy for _, energy in client.get_many(names)
+        if energy is not None]
+    if not energies:
+        print("Nothing to archive")
+        return
+
+    try:
+        _export_energies(energies, args.export)
+    except OSError as err:
+        raise WeException(
+            "Failed to export to {}: {}".format(args.export, str(err))) from err
+    _verify_export(energies, args.export)
+
+    responses = client.archive(
+        args.cutoff, [energy.name for energy in energies], wait=args.wait)
+    print("Exported {} records to {}, archived in {} transactions".format(
+        len(energies), args.export, len(responses)))
+
+
+def do_history(args):
+    client = _create_client(args)
+    names = client.get_participant_history(args.participant)
+    print("Response : ", " ".join(names))
+
+
+def _expand_name_range(first, last):
+    """Expands FIRST..LAST, two names which only differ by their trailing
+    number, e.g. 2021_01_01_00 and 2021_01_01_23.
+    """
+    first_match = re.match(r'^(.*?)(\d+)$', first)
+    last_match = re.match(r'^(.*?)(\d+)$', last)
+    if first_match is None or last_match is None or \
+            first_match.group(1) != last_match.group(1):
+        raise WeException(
+            "invalid range of names: {} {}".format(first, last))
+    prefix = first_match.group(1)
+    width = len(first_match.group(2))
+    return [
+        "{}{:0{}d}".format(prefix, number, width)
+        for number in range(
+            int(first_match.group(2)), int(last_match.group(2)) + 1)]
+
+
+def _load_client_config():
+    """Returns the settings of ~/.sawtooth/we.toml, e.g.
+
+        url = ["http://node1:8008", "http://node2:8008"]
+        routing = "least-latency"
+        timeout = 10
+        health_interval = 5
+        outbox = "/var/spool/we"
+        zmq_url = "tcp://localhost:4004"
+        compress_threshold = 65536
+
+    With an outbox, the submissions of we serve are stored on disk first;
+    the ones the REST API could not take yet are sent in the background
+    and, after a restart, by the next we serve. With
+    zmq_url, the validator is reached directly instead of through the
+    REST API. Records of at least compress_threshold bytes are stored
+    compressed.
+    """
+    filename = os.path.join(os.path.expanduser("~"), ".sawtooth", CONFIG_FILE)
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename) as fd:
+            config = toml.loads(fd.read())
+    except (IOError, toml.TomlDecodeError) as err:
+        raise WeException(
+            "Unable to load client configuration file {}: {}".format(
+                filename, str(err))) from err
+
+    invalid_keys = set(config).difference(CONFIG_KEYS)
+    if invalid_keys:
+        raise WeException("Invalid keys in client config: {}".format(
+            ", ".join(sorted(invalid_keys))))
+    return config
+
+
+def _client_settings(args, config):
+    """The settings deciding where and how records are sent, as returned
+    by WeClient.settings.
+    """
+    url = _get_url(args, config)
+    if isinstance(url, str):
+        url = [url.strip() for url in url.split(",")]
+    return {
+        'url': url,
+        'routing': args.routing or config.get('routing', 'round-robin'),
+        'zmq_url': config.get('zmq_url'),
+        'compress_threshold': config.get('compress_threshold'),
+    }
+
+
+def _create_client(args, keyfile=None, outbox=False, **kwargs):
+    """The outbox is only used by long running commands: a one-shot
+    command would exit before its records are drained.
+    """
+    config = _load_client_config()
+    settings = _client_settings(args, config)
+    return WeClient(
+        base_url=settings['url'],
+        keyfile=keyfile,
+        routing=settings['routing'],
+        timeout=config.get('timeout'),
+        health_interval=config.get('health_interval'),
+        outbox_dir=config.get('outbox') if outbox else None,
+        zmq_url=settings['zmq_url'],
+        compress_threshold=settings['compress_threshold'],
+        **kwargs)
+
+
+def _connect_daemon(args):
+    """Returns a connection to the we serve daemon when one is serving
+    with the settings of this invocation, None otherwise. The records are
+    then sent directly.
+    """
+    daemon = connect_daemon(args.socket)
+    if daemon is None:
+        return None
+    settings = _client_settings(args, _load_client_config())
+    try:
+        serving = daemon.info()
+    except WeException as err:
+        daemon.close()
+        print("Warning: not forwarding to the we serve daemon, its settings "
+              "are unknown ({}); sending directly".format(err),
+              file=sys.stderr)
+        return None
+    different = sorted(
+        key for key in settings if serving.get(key) != settings[key])
+    if different:
+        daemon.close()
+        print("Warning: the we serve daemon runs with another {}; sending "
+              "directly".format(", ".join(different)), file=sys.stderr)
+        return None
+    return daemon
+
+
+def _get_url(args, config=None):
+    if args.url:
+        return [url for urls in args.url for url in urls.split(",") if url]
+    if config and config.get('url'):
+        url = config['url']
+        return [url] if isinstance(url, str) else url
     return DEFAULT_URL
 
 def _get_keyfile(args):
@@ -206,6 +779,18 @@ def main(prog_name=os.path.basename(sys.argv[0]), args=None):
         do_set(args)
     elif args.command == 'get':
         do_get(args)
+    elif args.command == 'rollup':
+        do_rollup(args)
+    elif args.command == 'settle':
+        do_settle(args)
+    elif args.command == 'history':
+        do_history(args)
+    elif args.command == 'import':
+        do_import(args)
+    elif args.command == 'archive':
+        do_archive(args)
+    elif args.command == 'serve':
+        do_serve(args)
     else:
         raise WeException("invalid command: {}".format(args.command))
 
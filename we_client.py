@@ -13,22 +13,43 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
+import collections
+import concurrent.futures
 import hashlib
 import base64
+import json
+import logging
+import threading
 from base64 import b64encode
 import time
 import random
 import requests
+import requests.adapters
 import yaml
 import urllib.request
 
 from sawtooth_we.we_exceptions import WeException
+from sawtooth_we.we_outbox import Outbox
+from sawtooth_we.we_outbox import OutboxDrainer
+from sawtooth_we.we_routing import EndpointPool
+from sawtooth_we.we_submitter import CoalescingSubmitter
+from sawtooth_we.processor.we_payload import MAX_ARCHIVE_NAMES
+from sawtooth_we.processor.we_payload import validate_record
+from sawtooth_we.processor.we_state import Energy
+from sawtooth_we.processor.we_state import INDEX_HEAD
+from sawtooth_we.processor.we_state import MANIFEST_SHARD
+from sawtooth_we.processor.we_state import compress_entry
+from sawtooth_we.processor.we_state import decompress_entry
+from sawtooth_we.we_tracing import SubmissionTrace
+from sawtooth_we.we_zmq import MAX_STATUS_WAIT
+from sawtooth_we.we_zmq import ZmqTransport
 
 from sawtooth_signing import create_context
 from sawtooth_signing import CryptoFactory
 from sawtooth_signing import ParseError
 from sawtooth_signing.secp256k1 import Secp256k1PrivateKey
 
+from sawtooth_sdk.processor.exceptions import InvalidTransaction
 from sawtooth_sdk.protobuf.transaction_pb2 import TransactionHeader
 from sawtooth_sdk.protobuf.transaction_pb2 import Transaction
 from sawtooth_sdk.protobuf.batch_pb2 import BatchList
@@ -36,13 +57,148 @@ from sawtooth_sdk.protobuf.batch_pb2 import BatchHeader
 from sawtooth_sdk.protobuf.batch_pb2 import Batch
 
 
+LOGGER = logging.getLogger(__name__)
+
+
 def _sha512(data):
     return hashlib.sha512(data).hexdigest()
 
+
+def _deserialize_energy(name, data):
+    """Returns the Energy of name from the data of its address, which may
+    hold the energies of other names whose address collides.
+    """
+    for energy in data.decode().split("|"):
+        energy_name, listId, listConsumption = energy.split("-")
+        if energy_name == name:
+            return Energy(energy_name, listId, listConsumption)
+    return None
+
+
+def _set_flags(index, blind):
+    return tuple(
+        flag for flag, enabled in (('index', index), ('blind', blind))
+        if enabled)
+
+
+def _make_url(base_url, suffix):
+    if base_url.startswith("http://") or base_url.startswith("https://"):
+        return "{}/{}".format(base_url, suffix)
+    return "http://{}/{}".format(base_url, suffix)
+
+
+class BatchResult:
+    """Outcome of WeClient.set_many.
+
+    Attributes:
+        response (str): The REST API response, None when nothing was sent.
+        rejected (list of tuple): (name, reason) of the records which were
+            not committed.
+        committed (int): The number of records known to be committed.
+        pending (list of str): The names of the records still pending when
+            the wait expired.
+    """
+
+    def __init__(self):
+        self.response = None
+        self.rejected = []
+        self.committed = 0
+        self.pending = []
+
+
+class _Submission:
+    """A signed batch list kept for resubmission of retried transactions."""
+
+    def __init__(self, batch_list):
+        self.batch_list = batch_list
+        self.batch_id = batch_list.batches[0].header_signature
+        self.response = None
+
+
 class WeClient:
-    def __init__(self, base_url, keyfile=None):
+    def __init__(self, base_url, keyfile=None, trace_sink=None,
+                 idempotent=False, dedupe_size=4096, pool_size=16,
+                 routing='round-robin', timeout=None, health_interval=None,
+                 probe_timeout=2.0, outbox_dir=None, coalesce_delay=None,
+                 coalesce_size=256, max_queued=10000, zmq_url=None,
+                 compress_threshold=None):
+        """
+        Args:
+            base_url (str or list of str): The REST API endpoint, or several
+                of them, as a list or comma-separated.
+            routing (str): 'round-robin' or 'least-latency' over the
+                endpoints.
+            timeout (float): Seconds before a request fails over to the
+                next endpoint, None waits indefinitely.
+            health_interval (float): Seconds between two health probes of
+                the endpoints, None disables probing.
+            outbox_dir (str): When given, signed batch lists are appended
+                to a durable outbox in this directory and sent by a
+                background drainer, so submissions survive endpoint
+                outages and restarts. Submissions then return once the
+                batch list is on disk and do not wait for the commit.
+            coalesce_delay (float): When given, set queues its transaction
+                and returns a Future; a background submitter sends the
+                queued transactions together once coalesce_size are queued
+                or the oldest waited coalesce_delay seconds.
+            max_queued (int): The number of queued transactions past which
+                set blocks.
+            zmq_url (str): When given, batches, batch statuses and state
+                go straight to this validator component endpoint, e.g.
+                'tcp://localhost:4004', instead of through the REST API.
+            compress_threshold (int): When given, the records of set whose
+                serialization reaches this size in bytes are compressed
+                here and sent with setcompressed, the validators storing
+                the compressed bytes; reads decompress them transparently.
+        """
+        if isinstance(base_url, str):
+            base_url = [url.strip() for url in base_url.split(",")]
+        self._settings = {
+            'url': list(base_url),
+            'routing': routing,
+            'zmq_url': zmq_url,
+            'compress_threshold': compress_threshold,
+        }
+        try:
+            self._endpoints = EndpointPool(base_url, strategy=routing)
+        except ValueError as err:
+            raise WeException(err) from err
+        self._timeout = timeout
+        self._probe_timeout = probe_timeout
+        self._trace_sink = trace_sink
+        self._compress_threshold = compress_threshold
+        self._zmq = None
+        if zmq_url is not None:
+            self._zmq = ZmqTransport(zmq_url, timeout=timeout)
+
+        # Connections are reused across requests and threads
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=len(base_url), pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if health_interval is not None:
+            self._endpoints.start_probes(self._probe, health_interval)
+        self.last_trace = None
+
+        self._idempotent = idempotent
+        self._dedupe_size = dedupe_size
+        self._submitted = collections.OrderedDict()
+        self._submitted_lock = threading.Lock()
+
+        self._outbox = None
+        self._drainer = None
+        if outbox_dir is not None:
+            self._outbox = Outbox(outbox_dir)
+            self._drainer = OutboxDrainer(self._outbox, self)
+            # Records left over by a previous run are sent right away
+            self._drainer.start()
 
-        self._base_url = base_url
+        self._submitter = None
+        if coalesce_delay is not None:
+            self._submitter = CoalescingSubmitter(
+                self, max_batch=coalesce_size, max_delay=coalesce_delay,
+                max_queued=max_queued)
 
         if keyfile is None:
             self._signer = None
@@ -65,7 +221,36 @@ class WeClient:
         self._signer = CryptoFactory(create_context('secp256k1')) \
             .new_signer(private_key)
 
-    def set(self, name, listId, listConsumption, wait=None, auth_user=None, auth_password=None):
+    def set(self, name, listId, listConsumption, wait=None, auth_user=None, auth_password=None, sequence=0, index=False, blind=False):
+        """Sends the consumption recorded for name.
+
+        In idempotent mode, calling set again with the same arguments and
+        sequence is a retry of the same transaction; bump sequence to
+        deliberately write the same record again.
+
+        With index, name is also appended to the on-chain index of each
+        participant, read back with get_participant_history.
+
+        With blind, the processor writes the record without reading its
+        address first, saving a state round trip; the address must not be
+        shared with another name, which is the case unless two names
+        collide on 256 bits of SHA-512.
+
+        With a coalescing submitter, the signed transaction is queued and a
+        concurrent.futures.Future of the response is returned instead;
+        idempotent retries are not recognized on this path.
+        """
+        if self._submitter is not None:
+            payload, inputs, outputs = self._make_we_txn(
+                name, "set", listId, listConsumption,
+                flags=_set_flags(index, blind))
+            transaction = self._create_transaction(
+                self._create_header(
+                    payload, inputs, outputs,
+                    nonce=self._make_nonce(name, payload, sequence)),
+                payload)
+            return self._submitter.submit(name, transaction, wait=wait)
+
         return self._send_we_txn(
             name,
             "set",
@@ -73,30 +258,434 @@ class WeClient:
             listConsumption,
             wait=wait,
             auth_user=auth_user,
-            auth_password=auth_password)
+            auth_password=auth_password,
+            sequence=sequence,
+            flags=_set_flags(index, blind))
+
+    def set_many(self, records, wait=None, auth_user=None, auth_password=None, sequence=0, index=False, blind=False):
+        """Sends several records as the transactions of one batch.
+
+        Every record is checked with the rules of WePayload before
+        signing; the invalid ones are left out of the batch instead of
+        making the validator reject the whole batch.
+
+        When waiting, a batch which comes back INVALID is split and its
+        valid parts are resubmitted, see _submit_bisecting.
+
+        Args:
+            records (iterable): (name, listId, listConsumption) tuples.
+
+        Returns:
+            (BatchResult): The response and the rejected records.
+        """
+        flags = _set_flags(index, blind)
+        result = BatchResult()
+        names = []
+        txns = []
+        for name, listId, listConsumption in records:
+            try:
+                txns.append(self._make_we_txn(
+                    name, "set", listId, listConsumption, flags=flags))
+                names.append(name)
+            except WeException as err:
+                result.rejected.append((name, str(err)))
+
+        if not txns:
+            return result
+
+        # The outbox sends the batch later, there is nothing to wait for
+        if not (wait and wait > 0) or self._outbox is not None:
+            result.response = self._send_payloads(
+                "batch of {}".format(len(txns)), txns, wait=wait,
+                auth_user=auth_user, auth_password=auth_password,
+                sequence=sequence)
+            return result
+
+        transactions = [
+            self._create_transaction(
+                self._create_header(
+                    payload, inputs, outputs,
+                    nonce=self._make_nonce(name, payload, sequence)),
+                payload)
+            for name, (payload, inputs, outputs) in zip(names, txns)]
+        self._submit_bisecting(
+            names, transactions, wait, result,
+            auth_user=auth_user, auth_password=auth_password)
+        return result
+
+    def _submit_bisecting(self, names, transactions, wait, result,
+                          auth_user=None, auth_password=None,
+                          max_batches=None):
+        """Submits transactions as one batch and, while batches come back
+        INVALID, resubmits their valid parts.
+
+        A batch is invalid as a whole when one of its transactions is. The
+        validator reports the first invalid transaction it met: that one
+        is rejected with the reported reason and the rest is resubmitted.
+        A batch reported without invalid transactions is split in halves.
+        The batches of a round are sent in one BatchList and waited for
+        together, and the transactions are only signed once.
+
+        One poison record costs one extra submission when reported and
+        O(log n) when found by bisection; past max_batches submitted
+        batches the remaining records are rejected without resubmission.
+        """
+        if max_batches is None:
+            max_batches = 4 * (len(transactions).bit_length() + 1)
+
+        submitted = 0
+        groups = [list(range(len(transactions)))]
+        while groups:
+            if submitted + len(groups) > max_batches:
+                for group in groups:
+                    result.rejected.extend(
+                        (names[i], 'not resubmitted: bisection budget '
+                         'exhausted') for i in group)
+                break
+
+            batch_list = BatchList(batches=[
+                self.create_batch([transactions[i] for i in group])
+                for group in groups])
+            submitted += len(groups)
+            response = self.post_batches(
+                batch_list.SerializeToString(),
+                auth_user=auth_user,
+                auth_password=auth_password)
+            if result.response is None:
+                result.response = response
+            statuses = self.get_batch_statuses(
+                [batch.header_signature for batch in batch_list.batches],
+                wait, auth_user=auth_user, auth_password=auth_password)
+
+            next_groups = []
+            for group, batch in zip(groups, batch_list.batches):
+                entry = statuses.get(batch.header_signature, {})
+                status = entry.get('status')
+                if status == 'COMMITTED':
+                    result.committed += len(group)
+                elif status == 'INVALID':
+                    reported = {
+                        txn['id']: txn.get('message', '')
+                        for txn in entry.get('invalid_transactions', [])}
+                    invalid = [
+                        i for i in group
+                        if transactions[i].header_signature in reported]
+                    if invalid:
+                        result.rejected.extend(
+                            (names[i],
+                             reported[transactions[i].header_signature])
+                            for i in invalid)
+                        rest = [i for i in group if i not in invalid]
+                        if rest:
+                            next_groups.append(rest)
+                    elif len(group) == 1:
+                        result.rejected.append((names[group[0]], 'invalid'))
+                    else:
+                        half = len(group) // 2
+                        next_groups.append(group[:half])
+                        next_groups.append(group[half:])
+                else:
+                    # Still PENDING (or UNKNOWN) once the wait expired
+                    result.pending.extend(names[i] for i in group)
+            groups = next_groups
+
+        LOGGER.debug(
+            'Submitted %d records in %d batches: %d committed, %d rejected',
+            len(transactions), submitted, result.committed,
+            len(result.rejected))
+
+    def archive(self, cutoff, names, wait=None, auth_user=None, auth_password=None):
+        """Deletes the energies of names, which must all sort before
+        cutoff, from state, along with their settlements and the shards
+        and manifests of the names sent with set_sharded.
+
+        The names are sent MAX_ARCHIVE_NAMES per transaction.
+
+        Returns:
+            (list of str): The responses, one per transaction.
+        """
+        names = sorted(set(names))
+        for name in names:
+            if name >= cutoff:
+                raise WeException(
+                    '{} is not older than the cutoff {}'.format(name, cutoff))
+
+        responses = []
+        for start in range(0, len(names), MAX_ARCHIVE_NAMES):
+            chunk = names[start:start + MAX_ARCHIVE_NAMES]
+            addresses = sorted(
+                set(self._get_address(name) for name in chunk) |
+                set(self._get_settlement_address(name) for name in chunk) |
+                set(self._get_shard_prefix(name) for name in chunk))
+            payload = "-".join([cutoff, "archive", ",".join(chunk)]).encode()
+            responses.append(self._send_payload(
+                cutoff, payload, addresses, addresses, wait=wait,
+                auth_user=auth_user, auth_password=auth_password))
+        return responses
+
+    def get_participant_history(self, participant, auth_user=None, auth_password=None):
+        """Returns the names a participant appears in, in indexing order,
+        for the records sent with index.
+        """
+        entries = self._list_state(
+            self._get_index_prefix(participant),
+            auth_user=auth_user, auth_password=auth_password)
+        entries.pop(self._get_index_address(participant, INDEX_HEAD), None)
+
+        names = []
+        for address in sorted(entries):
+            names.extend(entries[address].decode().split(","))
+        return names
 
     
+    def set_sharded(self, name, listId, listConsumption, shards, wait=None, auth_user=None, auth_password=None, sequence=0):
+        """Sends the consumption of name split by participant id range.
+
+        Each of the shards is written by its own transaction to its own
+        address, so the validator can apply them in parallel; a manifest
+        transaction, sent first, records the id ranges and deletes the
+        shards left over by a previous split. All of them are sent as one
+        atomic batch.
+
+        Args:
+            shards (int): The number of shards, at most the number of
+                distinct participants.
+        """
+        self._serialize_record(name, listId, listConsumption)
+        records = sorted(zip(listId, listConsumption))
+        distinct = sorted(set(listId))
+        shards = max(1, min(shards, len(distinct)))
+        # Shard k holds the ids in [splits[k - 1], splits[k])
+        splits = [
+            distinct[len(distinct) * k // shards] for k in range(1, shards)]
+        stringSplits = self._convert_int_list_to_string(splits)
+
+        # The manifest deletes the shards past a smaller shard count, and
+        # every shard is checked against it
+        manifest_address = self._get_shard_address(name, MANIFEST_SHARD)
+        shard_prefix = self._get_shard_prefix(name)
+        txns = [(
+            "-".join([name, "manifest", stringSplits]).encode(),
+            [shard_prefix],
+            [shard_prefix])]
+        bounds = [None] + splits + [None]
+        for shard in range(shards):
+            low, high = bounds[shard], bounds[shard + 1]
+            shard_records = [
+                (i, c) for i, c in records
+                if (low is None or i >= low) and (high is None or i < high)]
+            address = self._get_shard_address(name, shard)
+            payload = "-".join([
+                name, "setshard", str(shard), stringSplits,
+                self._convert_int_list_to_string(
+                    [i for i, _ in shard_records]),
+                self._convert_int_list_to_string(
+                    [c for _, c in shard_records])]).encode()
+            txns.append((payload, [address, manifest_address], [address]))
+
+        return self._send_payloads(
+            name, txns, wait=wait, auth_user=auth_user,
+            auth_password=auth_password, sequence=sequence)
+
     def get(self, name, auth_user=None, auth_password=None):
+        """Returns the serialized energy of name, reassembled from its
+        shards when it was sent with set_sharded.
+        """
+        address = self._get_address(name)
+        found, data = self._get_state(
+            address,
+            name=name,
+            auth_user=auth_user,
+            auth_password=auth_password,
+            not_found_ok=True)
+        if not found:
+            return self._get_sharded(
+                name, auth_user=auth_user, auth_password=auth_password)
+        return data
+
+    def get_many(self, names, max_concurrency=16, auth_user=None, auth_password=None):
+        """Fetches the energies of names in parallel.
+
+        Args:
+            names (iterable of str): The names to fetch.
+            max_concurrency (int): The maximum number of requests in flight.
 
+        Yields:
+            (tuple): name (str) and Energy, or None when name is not part
+                of the BlockChain, in the order the requests complete.
+        """
+        addresses = ((name, self._get_address(name)) for name in names)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_concurrency) as executor:
+            pending = set()
+            for name, address in addresses:
+                pending.add(executor.submit(
+                    self._fetch_energy, name, address,
+                    auth_user, auth_password))
+                # Keep the number of queued requests bounded as well
+                if len(pending) >= 2 * max_concurrency:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+
+    def _fetch_energy(self, name, address, auth_user=None, auth_password=None):
+        found, data = self._get_state(
+            address,
+            name=name,
+            auth_user=auth_user,
+            auth_password=auth_password,
+            not_found_ok=True)
+        if not found:
+            data = self._get_sharded(
+                name, auth_user=auth_user, auth_password=auth_password,
+                not_found_ok=True)
+        if data is None:
+            return name, None
+        return name, _deserialize_energy(name, data)
+
+    def _get_sharded(self, name, auth_user=None, auth_password=None,
+                     not_found_ok=False):
+        entries = self._list_state(
+            self._get_shard_prefix(name),
+            auth_user=auth_user, auth_password=auth_password)
+        manifest = entries.pop(
+            self._get_shard_address(name, MANIFEST_SHARD), None)
+        if manifest is None:
+            if not_found_ok:
+                return None
+            raise WeException(
+                "the date and hour: {}".format(name),
+                "is not part of the BlockChain")
+
+        _, count, _ = manifest.decode().split("-")
+        listIds = []
+        listConsumptions = []
+        for shard in range(int(count)):
+            data = entries.get(self._get_shard_address(name, shard))
+            if data is None:
+                raise WeException(
+                    'Shard {} of {} is missing'.format(shard, name))
+            _, listId, listConsumption = data.decode().split("-")
+            if listId:
+                listIds.append(listId)
+                listConsumptions.append(listConsumption)
+
+        return "-".join(
+            [name, ",".join(listIds), ",".join(listConsumptions)]).encode()
+
+    def _list_state(self, prefix, auth_user=None, auth_password=None):
+        """Returns the data of every address under prefix, by address."""
+        if self._zmq is not None:
+            return self._zmq.list_state(prefix)
+
+        entries = {}
+        suffix = "state?address={}&limit=1000".format(prefix)
+        while suffix is not None:
+            result = yaml.safe_load(self._send_request(
+                suffix, auth_user=auth_user, auth_password=auth_password))
+            for entry in result.get("data", []):
+                entries[entry["address"]] = base64.b64decode(entry["data"])
+            paging = result.get("paging", {})
+            suffix = None
+            if paging.get("next_position"):
+                suffix = "state?address={}&limit=1000&start={}".format(
+                    prefix, paging["next_position"])
+        return entries
+
+    def rollup(self, name, members, level='day', wait=None, auth_user=None, auth_password=None):
+        """Stores the summary of a day or of a month.
+
+        Args:
+            name (str): The name of the summary, e.g. the day.
+            members (list of str): The hourly names summed into a day, or
+                the daily summary names summed into a month.
+            level (str): 'day' or 'month'.
+        """
+        if level == 'day':
+            inputs = [self._get_address(member) for member in members]
+        elif level == 'month':
+            inputs = [self._get_rollup_address(member) for member in members]
+        else:
+            raise WeException('Invalid rollup level: {}'.format(level))
+
+        summary_address = self._get_rollup_address(name)
+        payload = "-".join([name, "rollup", level, ",".join(members)]).encode()
+
+        return self._send_payload(
+            name, payload, inputs + [summary_address], [summary_address],
+            wait=wait, auth_user=auth_user, auth_password=auth_password)
+
+    def settle(self, name, producers, wait=None, auth_user=None, auth_password=None):
+        """Stores the netting of the hour name between its producers and
+        its other participants, the consumers.
+
+        Args:
+            producers (list of int): The ids of the producers of the hour.
+        """
         address = self._get_address(name)
-        result = self._send_request(
-            "state/{}".format(address),
+        settlement_address = self._get_settlement_address(name)
+        payload = "-".join([
+            name, "settle",
+            self._convert_int_list_to_string(producers)]).encode()
+
+        return self._send_payload(
+            name, payload, [address, settlement_address],
+            [settlement_address],
+            wait=wait, auth_user=auth_user, auth_password=auth_password)
+
+    def get_settlement(self, name, auth_user=None, auth_password=None):
+        address = self._get_settlement_address(name)
+        _, data = self._get_state(
+            address,
             name=name,
             auth_user=auth_user,
             auth_password=auth_password)
-        try:
-            return base64.b64decode(yaml.safe_load(result)["data"])
+        return data
 
-        except BaseException:
-            return None
+    def get_summary(self, name, auth_user=None, auth_password=None):
+        address = self._get_rollup_address(name)
+        _, data = self._get_state(
+            address,
+            name=name,
+            auth_user=auth_user,
+            auth_password=auth_password)
+        return data
 
     def _get_status(self, batch_id, wait, auth_user=None, auth_password=None):
+        return self.get_batch_statuses(
+            [batch_id], wait,
+            auth_user=auth_user,
+            auth_password=auth_password).get(batch_id, {}).get(
+                'status', 'UNKNOWN')
+
+    def get_batch_statuses(self, batch_ids, wait, auth_user=None, auth_password=None):
+        """Returns the status entries of the batches, by batch id, with the
+        invalid_transactions of the INVALID ones.
+
+        The ids are POSTed as a JSON list: in the query string, a few dozen
+        batch ids already exceed the request line size of the REST API.
+        """
+        if self._zmq is not None:
+            return self._zmq.batch_statuses(batch_ids, wait)
+
         try:
+            suffix = 'batch_statuses'
+            if wait and wait > 0:
+                # The REST API forwards the wait as a uint32
+                suffix += '?wait={}'.format(min(int(wait), MAX_STATUS_WAIT))
             result = self._send_request(
-                'batch_statuses?id={}&wait={}'.format(batch_id, wait),
+                suffix,
+                json.dumps(list(batch_ids)).encode(),
+                'application/json',
                 auth_user=auth_user,
                 auth_password=auth_password)
-            return yaml.safe_load(result)['data'][0]['status']
+            return {
+                entry['id']: entry
+                for entry in yaml.safe_load(result)['data']}
         except BaseException as err:
             raise WeException(err) from err
 
@@ -108,18 +697,90 @@ class WeClient:
         game_address = _sha512(name.encode('utf-8'))[0:64]
         return we_prefix + game_address
 
+    def _get_shard_prefix(self, name):
+        return self._get_prefix() + \
+            _sha512('shard-{}'.format(name).encode('utf-8'))[0:60]
+
+    def _get_shard_address(self, name, shard):
+        return self._get_shard_prefix(name) + '{:04x}'.format(shard)
+
+    def _get_index_prefix(self, participant):
+        return self._get_prefix() + \
+            _sha512('index-{}'.format(participant).encode('utf-8'))[0:60]
+
+    def _get_index_address(self, participant, page):
+        return self._get_index_prefix(participant) + '{:04x}'.format(page)
+
+    def _get_settlement_address(self, name):
+        return self._get_prefix() + \
+            _sha512('settle-{}'.format(name).encode('utf-8'))[0:64]
+
+    def _get_rollup_address(self, name):
+        return self._get_prefix() + \
+            _sha512('rollup-{}'.format(name).encode('utf-8'))[0:64]
+
+    def _get_state(self, address, name=None, auth_user=None,
+                   auth_password=None, not_found_ok=False):
+        """Reads the data stored at address.
+
+        Returns:
+            (tuple): found (bool) and the data (bytes), None when the
+                response cannot be decoded.
+
+        Raises:
+            WeException: There is no data at address and not not_found_ok.
+        """
+        if self._zmq is not None:
+            data = self._zmq.get_state(address)
+            if data is None and not not_found_ok:
+                raise WeException(
+                    "the date and hour: {}".format(name),
+                    "is not part of the BlockChain")
+            if data is None:
+                return False, None
+            return True, self._decompress(data)
+
+        result = self._send_request(
+            "state/{}".format(address),
+            name=name,
+            auth_user=auth_user,
+            auth_password=auth_password,
+            not_found_ok=not_found_ok)
+        if result is None:
+            return False, None
+        try:
+            data = base64.b64decode(yaml.safe_load(result)["data"])
+
+        except BaseException:
+            return True, None
+        return True, self._decompress(data)
+
+    def _decompress(self, data):
+        try:
+            return decompress_entry(data)
+        except ValueError as err:
+            raise WeException(err) from err
+
+    def post_batches(self, data, auth_user=None, auth_password=None):
+        """Submits a serialized BatchList to the validator, bypassing the
+        outbox.
+        """
+        if self._zmq is not None:
+            return self._zmq.submit_batches(data)
+        return self._send_request(
+            "batches", data,
+            'application/octet-stream',
+            auth_user=auth_user,
+            auth_password=auth_password)
+
     def _send_request(self,
                       suffix,
                       data=None,
                       content_type=None,
                       name=None,
                       auth_user=None,
-                      auth_password=None):
-        if self._base_url.startswith("http://"):
-            url = "{}/{}".format(self._base_url, suffix)
-        else:
-            url = "http://{}/{}".format(self._base_url, suffix)
-
+                      auth_password=None,
+                      not_found_ok=False):
         headers = {}
         if auth_user is not None:
             auth_string = "{}:{}".format(auth_user, auth_password)
@@ -130,29 +791,87 @@ class WeClient:
         if content_type is not None:
             headers['Content-Type'] = content_type
 
-        try:
-            if data is not None:
-                result = requests.post(url, headers=headers, data=data)
-            else:
-                result = requests.get(url, headers=headers)
+        error = None
+        # Fail over to the next endpoint when one is unreachable or
+        # overloaded; resubmitting a batch is safe since its id is unique
+        for endpoint in self._endpoints.candidates():
+            url = _make_url(endpoint.url, suffix)
+            start = time.monotonic()
+            try:
+                if data is not None:
+                    result = self._session.post(
+                        url, headers=headers, data=data,
+                        timeout=self._timeout)
+                else:
+                    result = self._session.get(
+                        url, headers=headers, timeout=self._timeout)
+            except requests.RequestException as err:
+                self._endpoints.record_failure(endpoint)
+                error = WeException(
+                    'Failed to connect to {}: {}'.format(url, str(err)))
+                continue
+            except BaseException as err:
+                raise WeException(err) from err
+
+            if result.status_code >= 500 or result.status_code == 429:
+                if result.status_code != 429:
+                    self._endpoints.record_failure(endpoint)
+                error = WeException("Error {}: {}".format(
+                    result.status_code, result.reason))
+                continue
+
+            self._endpoints.record_success(
+                endpoint, time.monotonic() - start)
 
             if result.status_code == 404:
+                if not_found_ok:
+                    return None
                 raise WeException("the date and hour: {}".format(name), "is not part of the BlockChain")
 
             if not result.ok:
                 raise WeException("Error {}: {}".format(
                     result.status_code, result.reason))
 
-        except requests.ConnectionError as err:
-            raise WeException(
-                'Failed to connect to {}: {}'.format(url, str(err))) from err
+            return result.text
 
-        except BaseException as err:
-            raise WeException(err) from err
+        raise error
+
+    def _probe(self, url):
+        result = self._session.get(
+            _make_url(url, "blocks?limit=1"), timeout=self._probe_timeout)
+        result.raise_for_status()
+
+    def record_trace(self, trace):
+        """Hands a finished SubmissionTrace to the trace sink, if any."""
+        if self._trace_sink is not None:
+            self._trace_sink.record(trace)
 
-        return result.text
+    @property
+    def settings(self):
+        """The settings deciding where and how records are sent: url,
+        routing, zmq_url and compress_threshold.
+        """
+        return dict(self._settings)
 
+    @property
+    def submitter(self):
+        """The CoalescingSubmitter behind set, None when not coalescing."""
+        return self._submitter
 
+    def close(self):
+        """Flushes the coalesced transactions, stops the outbox drainer and
+        the health probes and closes the pooled connections. Records still
+        in the outbox are sent by the next client opening it.
+        """
+        if self._submitter is not None:
+            self._submitter.close()
+        if self._drainer is not None:
+            self._drainer.stop()
+            self._outbox.close()
+        if self._zmq is not None:
+            self._zmq.close()
+        self._endpoints.stop_probes()
+        self._session.close()
 
     def _send_we_txn(self, name,
                      action,
@@ -160,65 +879,259 @@ class WeClient:
                      listConsumption,
                      wait=None,
                      auth_user=None,
-                     auth_password=None):
+                     auth_password=None,
+                     sequence=0,
+                     flags=()):
+        trace = SubmissionTrace(name)
+
+        payload, inputs, outputs = self._make_we_txn(
+            name, action, listId, listConsumption, flags=flags)
+
+        return self._send_payload(
+            name, payload, inputs, outputs, trace=trace,
+            wait=wait, auth_user=auth_user, auth_password=auth_password,
+            sequence=sequence)
+
+    def _serialize_record(self, name, listId, listConsumption):
+        """Returns the serialized lists of a record, checked with the same
+        rules as WePayload.
+
+        Raises:
+            WeException: The record would be rejected by WePayload.
+        """
         # Serialization is just a delimited utf-8 encoded string
         listStringId = self._convert_int_list_to_string(listId)
         listStringConsummer = self._convert_int_list_to_string(listConsumption)
-        payload = "-".join([name, action, listStringId, listStringConsummer]).encode()
+        try:
+            validate_record(name, listStringId, listStringConsummer)
+        except InvalidTransaction as err:
+            raise WeException(
+                'Invalid record {}: {}'.format(name, err)) from err
+        return listStringId, listStringConsummer
+
+    def _make_we_txn(self, name, action, listId, listConsumption, flags=()):
+        """Returns the payload, inputs and outputs of a transaction.
+
+        Raises:
+            WeException: The record would be rejected by WePayload.
+        """
+        listStringId, listStringConsummer = self._serialize_record(
+            name, listId, listConsumption)
+        fields = [name, action, listStringId, listStringConsummer]
+        if action == "set" and self._compress_threshold is not None and \
+                len(listStringId) + len(listStringConsummer) >= \
+                self._compress_threshold:
+            entry = compress_entry("-".join(
+                [name, listStringId, listStringConsummer]).encode())
+            fields = [name, "setcompressed", b64encode(entry).decode()]
+        if flags:
+            fields.append(",".join(flags))
+        payload = "-".join(fields).encode()
         # Construct the address
-        address = self._get_address(name)
+        addresses = [self._get_address(name)]
+        if 'index' in flags:
+            # The prefix covers the head and all the pages of the index
+            addresses.extend(
+                self._get_index_prefix(participant)
+                for participant in sorted(set(listId)))
+
+        return payload, addresses, addresses
+
+    def _send_payload(self, name, payload, inputs, outputs, trace=None,
+                      wait=None, auth_user=None, auth_password=None,
+                      sequence=0):
+        return self._send_payloads(
+            name, [(payload, inputs, outputs)], trace=trace, wait=wait,
+            auth_user=auth_user, auth_password=auth_password,
+            sequence=sequence)
+
+    def _send_payloads(self, name, txns, trace=None, wait=None,
+                       auth_user=None, auth_password=None, sequence=0):
+        """Signs (payload, inputs, outputs) tuples as the transactions of
+        one atomic batch and submits it.
+        """
+        if trace is None:
+            trace = SubmissionTrace(name)
+        self.last_trace = trace
+        trace.mark('build')
+
+        try:
+            if self._idempotent:
+                return self._send_idempotent(
+                    name, txns, sequence, trace,
+                    wait=wait, auth_user=auth_user,
+                    auth_password=auth_password)
+
+            transactions = [
+                self._create_transaction(
+                    self._create_header(
+                        payload, inputs, outputs,
+                        nonce=self._make_nonce(name, payload, sequence)),
+                    payload)
+                for payload, inputs, outputs in txns]
+            batch_list = self._create_batch_list(transactions)
+            batch_id = batch_list.batches[0].header_signature
+            trace.batch_id = batch_id
+            trace.mark('sign')
+
+            return self.submit_batch_list(
+                batch_list, batch_id, trace, wait=wait,
+                auth_user=auth_user, auth_password=auth_password)
+        finally:
+            self.record_trace(trace)
 
-        header = TransactionHeader(
+    def _send_idempotent(self, name, txns, sequence, trace, wait=None,
+                         auth_user=None, auth_password=None):
+        """Submits transactions whose nonces are derived from their content.
+
+        A retry of the same (name, payloads, sequence) yields the same
+        headers, so it is recognized in the store of recent submissions:
+        if the validator already knows the batch, the retry only polls its
+        status, otherwise the batch signed the first time is sent again.
+        """
+        headers = [
+            self._create_header(
+                payload, inputs, outputs,
+                nonce=self._make_nonce(name, payload, sequence))
+            for payload, inputs, outputs in txns]
+        key = _sha512(b''.join(headers))
+
+        with self._submitted_lock:
+            record = self._submitted.get(key)
+            if record is None:
+                batch_list = self._create_batch_list([
+                    self._create_transaction(header, payload)
+                    for header, (payload, _, _) in zip(headers, txns)])
+                record = _Submission(batch_list)
+                self._submitted[key] = record
+                if len(self._submitted) > self._dedupe_size:
+                    self._submitted.popitem(last=False)
+                resubmit = True
+            else:
+                self._submitted.move_to_end(key)
+                resubmit = False
+
+        trace.batch_id = record.batch_id
+        trace.mark('sign')
+
+        if not resubmit:
+            status = self._get_status(
+                record.batch_id, 0,
+                auth_user=auth_user, auth_password=auth_password)
+            if status != 'UNKNOWN':
+                LOGGER.debug(
+                    'Batch %s already submitted (%s), not resubmitting',
+                    record.batch_id, status)
+                trace.status = status
+                if wait and wait > 0 and status == 'PENDING':
+                    status = self._wait_for_status(
+                        record.batch_id, wait, trace,
+                        auth_user=auth_user,
+                        auth_password=auth_password) or status
+                if record.response is None:
+                    # The first attempt failed after reaching the validator
+                    return json.dumps(
+                        {'batch_id': record.batch_id, 'status': status})
+                return record.response
+
+        record.response = self.submit_batch_list(
+            record.batch_list, record.batch_id, trace, wait=wait,
+            auth_user=auth_user, auth_password=auth_password)
+        return record.response
+
+    def _make_nonce(self, name, payload, sequence):
+        """Returns a nonce derived from the content in idempotent mode, a
+        random one otherwise.
+        """
+        if self._idempotent:
+            return _sha512('{}|{}|{}'.format(
+                name, _sha512(payload), sequence).encode())[0:32]
+        return hex(random.randint(0, 2**64))
+
+    def _create_header(self, payload, inputs, outputs, nonce):
+        return TransactionHeader(
             signer_public_key=self._signer.get_public_key().as_hex(),
             family_name="we",
             family_version="1.0",
-            inputs=[address],
-            outputs=[address],
+            inputs=inputs,
+            outputs=outputs,
             dependencies=[],
             payload_sha512=_sha512(payload),
             batcher_public_key=self._signer.get_public_key().as_hex(),
-            nonce=hex(random.randint(0, 2**64))
+            nonce=nonce
         ).SerializeToString()
 
+    def _create_transaction(self, header, payload):
         signature = self._signer.sign(header)
 
-        transaction = Transaction(
+        return Transaction(
             header=header,
             payload=payload,
             header_signature=signature
         )
 
-        batch_list = self._create_batch_list([transaction])
-        batch_id = batch_list.batches[0].header_signature
+    def submit_batch_list(self, batch_list, batch_id, trace, wait=None,
+                          auth_user=None, auth_password=None):
+        """Submits a BatchList, through the outbox when there is one.
+
+        Args:
+            batch_list (BatchList): The signed batches.
+            batch_id (str): The batch waited for.
+            trace (SubmissionTrace): Marked at each stage of the
+                submission.
+            wait (int): Seconds to wait for batch_id to commit.
+
+        Returns:
+            (str): The response of the REST API.
+        """
+        data = batch_list.SerializeToString()
+        if self._outbox is not None:
+            seq = self._outbox.append(data)
+            self._drainer.notify()
+            trace.mark('accepted')
+            return 'Batch {} queued in outbox as record {}'.format(
+                batch_id, seq)
+
+        trace.mark('send')
+        response = self.post_batches(
+            data, auth_user=auth_user, auth_password=auth_password)
+        trace.mark('accepted')
 
         if wait and wait > 0:
-            wait_time = 0
-            start_time = time.time()
-            response = self._send_request(
-                "batches", batch_list.SerializeToString(),
-                'application/octet-stream',
+            self._wait_for_status(
+                batch_id, wait, trace,
+                auth_user=auth_user, auth_password=auth_password)
+
+        return response
+
+    def _wait_for_status(self, batch_id, wait, trace, auth_user=None,
+                         auth_password=None):
+        wait_time = 0
+        start_time = time.time()
+        status = None
+        while wait_time < wait:
+            status = self._get_status(
+                batch_id,
+                wait - int(wait_time),
                 auth_user=auth_user,
                 auth_password=auth_password)
-            while wait_time < wait:
-                status = self._get_status(
-                    batch_id,
-                    wait - int(wait_time),
-                    auth_user=auth_user,
-                    auth_password=auth_password)
-                wait_time = time.time() - start_time
-
-                if status != 'PENDING':
-                    return response
+            wait_time = time.time() - start_time
 
-            return response
+            if status != 'PENDING':
+                trace.status = status
+                if status == 'COMMITTED':
+                    trace.mark('committed')
+                return status
 
-        return self._send_request(
-            "batches", batch_list.SerializeToString(),
-            'application/octet-stream',
-            auth_user=auth_user,
-            auth_password=auth_password)
+        return status
 
     def _create_batch_list(self, transactions):
+        return BatchList(batches=[self.create_batch(transactions)])
+
+    def create_batch(self, transactions):
+        """Returns a Batch of the transactions signed with the key of the
+        client.
+        """
         transaction_signatures = [t.header_signature for t in transactions]
 
         header = BatchHeader(
@@ -228,11 +1141,10 @@ class WeClient:
 
         signature = self._signer.sign(header)
 
-        batch = Batch(
+        return Batch(
             header=header,
             transactions=transactions,
             header_signature=signature)
-        return BatchList(batches=[batch])
     
     def _convert_int_list_to_string(self, listInt):
         string_ints = [str(int) for int in listInt]
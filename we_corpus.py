@@ -0,0 +1,263 @@
+# Copyright 2017 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Generation and streaming of pre-signed 'we' transaction corpora.
+
+A corpus file is the magic header followed by length-prefixed records,
+each record being one serialized Batch:
+
+    MAGIC | (uint32 big-endian length | Batch bytes)*
+
+The file is written once and can then be memory-mapped by replay and load
+tools, which stream the batches without parsing or re-signing them.
+"""
+
+import datetime
+import mmap
+import multiprocessing
+import random
+import struct
+import weakref
+
+from sawtooth_signing import create_context
+from sawtooth_signing import CryptoFactory
+from sawtooth_signing.secp256k1 import Secp256k1PrivateKey
+
+from sawtooth_we.we_exceptions import WeException
+from sawtooth_we.we_message_factory import WeMessageFactory
+
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+
+
+MAGIC = b'WECORP01'
+
+_LENGTH = struct.Struct('>I')
+
+# Field 1 (batches), wire type 2 (length delimited) of BatchList
+_BATCH_LIST_TAG = b'\x0a'
+
+# Per-process factory used by the pool workers
+_WORKER_FACTORY = None
+
+
+def synthetic_records(count, participants, start=None, seed=None,
+                      name_format='%Y_%m_%d_%H'):
+    """Yields realistic hourly records for a community.
+
+    Args:
+        count (int): The number of hourly records.
+        participants (int): The number of participants per record.
+        start (datetime.datetime): The hour of the first record.
+        seed (int): Seed of the random consumption values.
+        name_format (str): strftime format used to build the names.
+
+    Yields:
+        (tuple): name (str), listId (list of int),
+            listConsumption (list of int)
+    """
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime.datetime(2021, 1, 1)
+    listId = list(range(1, participants + 1))
+    for hour in range(count):
+        name = (start + datetime.timedelta(hours=hour)).strftime(name_format)
+        # Values are non-negative, '-' delimits the payload fields
+        listConsumption = [rng.randint(0, 3000) for _ in listId]
+        yield name, listId, listConsumption
+
+
+def _init_worker(private_key_hex):
+    global _WORKER_FACTORY  # pylint: disable=global-statement
+    private_key = Secp256k1PrivateKey.from_hex(private_key_hex)
+    signer = CryptoFactory(create_context('secp256k1')).new_signer(
+        private_key)
+    _WORKER_FACTORY = WeMessageFactory(signer=signer)
+
+
+def _sign_chunk(chunk):
+    records, batch_size = chunk
+    batches = []
+    for start in range(0, len(records), batch_size):
+        transactions = [
+            _WORKER_FACTORY.create_transaction(
+                name, 'set', listId, listConsumption)
+            for name, listId, listConsumption
+            in records[start:start + batch_size]]
+        # The factory returns a serialized BatchList holding the one batch
+        batch_list = BatchList()
+        batch_list.ParseFromString(_WORKER_FACTORY.create_batch(transactions))
+        batches.append(batch_list.batches[0].SerializeToString())
+    return batches
+
+
+def _chunks(records, chunk_size, batch_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk, batch_size
+            chunk = []
+    if chunk:
+        yield chunk, batch_size
+
+
+def write_corpus(filename, records, private_key_hex=None, batch_size=1,
+                 workers=None, chunk_size=256):
+    """Signs records in parallel and writes them as a corpus file.
+
+    Args:
+        filename (str): The corpus file to create.
+        records (iterable): (name, listId, listConsumption) tuples.
+        private_key_hex (str): The signing key; a random key is used when
+            not given.
+        batch_size (int): The number of transactions per batch.
+        workers (int): The number of signing processes, defaults to the
+            number of CPUs.
+        chunk_size (int): The number of records handed to a worker at once.
+
+    Returns:
+        (int): The number of batches written.
+    """
+    if batch_size < 1:
+        raise WeException('batch_size must be at least 1')
+    if private_key_hex is None:
+        private_key_hex = \
+            create_context('secp256k1').new_random_private_key().as_hex()
+
+    # Keep chunks aligned on batch boundaries so batches stay full
+    chunk_size = max(batch_size, chunk_size - chunk_size % batch_size)
+
+    written = 0
+    with open(filename, 'wb') as fd, multiprocessing.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(private_key_hex,)) as pool:
+        fd.write(MAGIC)
+        # imap keeps the corpus in the order of the records
+        for batches in pool.imap(
+                _sign_chunk, _chunks(records, chunk_size, batch_size)):
+            for batch in batches:
+                fd.write(_LENGTH.pack(len(batch)))
+                fd.write(batch)
+            written += len(batches)
+
+    return written
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+class CorpusReader:
+    """Memory-maps a corpus file and streams the batches it contains."""
+
+    def __init__(self, filename):
+        self._fd = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(
+                self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as err:
+            self._fd.close()
+            raise WeException(
+                'Empty corpus file {}'.format(filename)) from err
+        # Open batch iterators, closed before the map they point into
+        self._iterators = weakref.WeakSet()
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise WeException('Not a corpus file: {}'.format(filename))
+
+    def close(self):
+        for iterator in list(self._iterators):
+            iterator.close()
+        self._map.close()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_batches()
+
+    def _records(self):
+        """Yields the offset and length of each stored Batch."""
+        offset = len(MAGIC)
+        end = len(self._map)
+        while offset < end:
+            if offset + _LENGTH.size > end:
+                raise WeException(
+                    'Truncated corpus record at offset {}'.format(offset))
+            length, = _LENGTH.unpack_from(self._map, offset)
+            offset += _LENGTH.size
+            if offset + length > end:
+                raise WeException(
+                    'Truncated corpus record at offset {}'.format(offset))
+            yield offset, length
+            offset += length
+
+    def iter_batches(self):
+        """Yields each serialized Batch as a zero-copy memoryview.
+
+        A view is released when the next batch is read, when the iteration
+        stops and when the reader is closed; keep bytes(batch) to use a
+        batch past that point.
+        """
+        iterator = self._iter_views()
+        self._iterators.add(iterator)
+        return iterator
+
+    def _iter_views(self):
+        view = memoryview(self._map)
+        batch = None
+        try:
+            for offset, length in self._records():
+                batch = view[offset:offset + length]
+                yield batch
+                batch.release()
+                batch = None
+        finally:
+            if batch is not None:
+                batch.release()
+            view.release()
+
+    def iter_batch_lists(self, batches_per_list=1):
+        """Yields serialized BatchLists ready to be POSTed to /batches.
+
+        The BatchList encoding is assembled directly from the stored batch
+        bytes, so the batches are neither parsed nor signed again.
+
+        Args:
+            batches_per_list (int): The number of batches per BatchList.
+        """
+        parts = []
+        count = 0
+        for offset, length in self._records():
+            parts.append(_BATCH_LIST_TAG)
+            parts.append(_encode_varint(length))
+            parts.append(self._map[offset:offset + length])
+            count += 1
+            if count == batches_per_list:
+                yield b''.join(parts)
+                parts = []
+                count = 0
+        if parts:
+            yield b''.join(parts)
@@ -16,6 +16,10 @@
 from sawtooth_processor_test.message_factory import MessageFactory
 
 
+def _join_ints(values):
+    return ",".join(str(value) for value in values)
+
+
 class WeMessageFactory:
     def __init__(self, signer=None):
         self._factory = MessageFactory(
@@ -24,9 +28,9 @@ class WeMessageFactory:
             namespace=MessageFactory.sha512("we".encode("utf-8"))[0:6],
             signer=signer)
 
-    def _game_to_address(self, game):
+    def _name_to_address(self, name):
         return self._factory.namespace + \
-            self._factory.sha512(game.encode())[0:64]
+            self._factory.sha512(name.encode())[0:64]
 
     def create_tp_register(self):
         return self._factory.create_tp_register()
@@ -34,55 +38,74 @@ class WeMessageFactory:
     def create_tp_response(self, status):
         return self._factory.create_tp_response(status)
 
-    def _create_txn(self, txn_function, game, action, space=None):
-        payload = ",".join([
-            str(game), str(action), str(space)
+    def create_payload(self, name, action, listId, listConsumption):
+        """Builds the delimited payload parsed by WePayload.
+
+        Args:
+            name (str): The date and hour of the recorded consumption.
+            action (str): The action, e.g. 'set'.
+            listId (list of int): The ids of the participants.
+            listConsumption (list of int): The consumption of each
+                participant.
+
+        Returns:
+            (bytes): The UTF-8 encoded payload.
+        """
+        return "-".join([
+            str(name), str(action),
+            _join_ints(listId), _join_ints(listConsumption)
         ]).encode()
 
-        addresses = [self._game_to_address(game)]
+    def _create_txn(self, txn_function, name, action, listId,
+                    listConsumption):
+        payload = self.create_payload(name, action, listId, listConsumption)
+
+        addresses = [self._name_to_address(name)]
 
         return txn_function(payload, addresses, addresses, [])
 
-    def create_tp_process_request(self, action, game, space=None):
+    def create_tp_process_request(self, action, name, listId,
+                                  listConsumption):
         txn_function = self._factory.create_tp_process_request
-        return self._create_txn(txn_function, game, action, space)
+        return self._create_txn(
+            txn_function, name, action, listId, listConsumption)
 
-    def create_transaction(self, game, action, space=None):
+    def create_transaction(self, name, action, listId, listConsumption):
         txn_function = self._factory.create_transaction
-        return self._create_txn(txn_function, game, action, space)
+        return self._create_txn(
+            txn_function, name, action, listId, listConsumption)
 
-    def create_get_request(self, game):
-        addresses = [self._game_to_address(game)]
+    def create_batch(self, transactions):
+        return self._factory.create_batch(transactions)
+
+    def create_get_request(self, name):
+        addresses = [self._name_to_address(name)]
         return self._factory.create_get_request(addresses)
 
-    def create_get_response(
-        self, game, board="---------", state="P1-NEXT", player1="", player2=""
-    ):
-        address = self._game_to_address(game)
+    def _create_state_data(self, name, listId, listConsumption):
+        # Same layout as WeState._serialize for a single energy entry
+        if listId is None:
+            return None
+        return "-".join([
+            name, _join_ints(listId), _join_ints(listConsumption)
+        ]).encode()
+
+    def create_get_response(self, name, listId=None, listConsumption=None):
+        address = self._name_to_address(name)
 
-        data = None
-        if board is not None:
-            data = ",".join([game, board, state, player1, player2]).encode()
-        else:
-            data = None
+        data = self._create_state_data(name, listId, listConsumption)
 
         return self._factory.create_get_response({address: data})
 
-    def create_set_request(
-        self, game, board="---------", state="P1-NEXT", player1="", player2=""
-    ):
-        address = self._game_to_address(game)
+    def create_set_request(self, name, listId=None, listConsumption=None):
+        address = self._name_to_address(name)
 
-        data = None
-        if state is not None:
-            data = ",".join([game, board, state, player1, player2]).encode()
-        else:
-            data = None
+        data = self._create_state_data(name, listId, listConsumption)
 
         return self._factory.create_set_request({address: data})
 
-    def create_set_response(self, game):
-        addresses = [self._game_to_address(game)]
+    def create_set_response(self, name):
+        addresses = [self._name_to_address(name)]
         return self._factory.create_set_response(addresses)
 
     def get_public_key(self):
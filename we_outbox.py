@@ -0,0 +1,412 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Durable outbox of signed batch lists.
+
+Batch lists are appended to a write-ahead log made of segment files named
+after the sequence number of their first record. Each record is
+
+    uint32 length | uint32 crc32 | uint64 sequence | BatchList bytes
+
+Appends are made durable with group commit: concurrent appenders share
+one fsync. The sequence of the last record known to be committed is kept
+in the 'acked' file; segments holding only acknowledged records are
+deleted. On restart, a torn record at the tail of the last segment is
+truncated away and the records after 'acked' are sent again. While
+running, reading resumes right after the last acknowledged record.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from sawtooth_we.we_exceptions import WeException
+
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+
+
+LOGGER = logging.getLogger(__name__)
+
+_RECORD = struct.Struct('>IIQ')
+
+_SEGMENT_SUFFIX = '.wal'
+
+_ACKED = 'acked'
+
+
+def _segment_name(first_seq):
+    return '{:020d}{}'.format(first_seq, _SEGMENT_SUFFIX)
+
+
+def _read_records(path, offset=0):
+    """Yields (offset, sequence, data) of the valid records of a segment
+    from offset on, stopping at the first torn or corrupted one.
+    """
+    with open(path, 'rb') as fd:
+        fd.seek(offset)
+        while True:
+            header = fd.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            length, crc, seq = _RECORD.unpack(header)
+            data = fd.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                return
+            yield offset, seq, data
+            offset += _RECORD.size + length
+
+
+class Outbox:
+    """Crash-safe append-only log of signed batch lists.
+
+    Args:
+        directory (str): The directory holding the segments.
+        segment_size (int): The size in bytes past which a new segment is
+            started.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._lock = threading.Lock()
+        self._sync_cond = threading.Condition()
+        self._syncing = False
+        self._synced = 0
+        self._written = 0
+        # (path, offset) following the last acknowledged record, and the
+        # positions following the records returned by the last pending
+        self._cursor = None
+        self._read_ends = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._acked = self._load_acked()
+        self._segments = self._recover()
+
+        if self._segments:
+            last_first, last_path = self._segments[-1]
+            last_seq = last_first - 1
+            for _, seq, _ in _read_records(last_path):
+                last_seq = seq
+            self._next_seq = last_seq + 1
+        else:
+            self._next_seq = self._acked + 1
+        self._written = self._synced = self._next_seq - 1
+
+        self._fd = None
+        self._open_segment()
+
+    def _load_acked(self):
+        try:
+            with open(os.path.join(self._directory, _ACKED)) as fd:
+                return int(fd.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError as err:
+            raise WeException(
+                'Corrupted outbox acked file in {}'.format(
+                    self._directory)) from err
+
+    def _recover(self):
+        """Lists the segments and truncates a torn tail in the last one."""
+        segments = sorted(
+            (int(filename[:-len(_SEGMENT_SUFFIX)]),
+             os.path.join(self._directory, filename))
+            for filename in os.listdir(self._directory)
+            if filename.endswith(_SEGMENT_SUFFIX))
+        if segments:
+            path = segments[-1][1]
+            end = 0
+            for offset, _, data in _read_records(path):
+                end = offset + _RECORD.size + len(data)
+            if end < os.path.getsize(path):
+                LOGGER.warning(
+                    'Truncating torn outbox record at %s:%d', path, end)
+                with open(path, 'r+b') as fd:
+                    fd.truncate(end)
+                    os.fsync(fd.fileno())
+        return segments
+
+    def _open_segment(self):
+        if self._segments and \
+                os.path.getsize(self._segments[-1][1]) < self._segment_size:
+            path = self._segments[-1][1]
+        else:
+            path = os.path.join(
+                self._directory, _segment_name(self._next_seq))
+            self._segments.append((self._next_seq, path))
+        self._fd = open(path, 'ab')
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, data):
+        """Appends a serialized BatchList and returns its sequence once
+        it is on disk.
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            if self._fd.tell() >= self._segment_size:
+                self._rotate()
+            self._fd.write(_RECORD.pack(len(data), zlib.crc32(data), seq))
+            self._fd.write(data)
+            self._written = seq
+        self._sync(seq)
+        return seq
+
+    def _rotate(self):
+        # Called with the lock held; the old segment is synced first
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._fd.close()
+        self._segments.append(
+            (self._next_seq - 1,
+             os.path.join(self._directory, _segment_name(self._next_seq - 1))))
+        self._fd = open(self._segments[-1][1], 'ab')
+        self._fsync_directory()
+
+    def _sync(self, seq):
+        """Group commit: one appender fsyncs for every record written so
+        far while the others wait for it.
+        """
+        with self._sync_cond:
+            while self._synced < seq:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                synced = None
+                self._sync_cond.release()
+                try:
+                    with self._lock:
+                        self._fd.flush()
+                        target = self._written
+                        fd = os.dup(self._fd.fileno())
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    synced = target
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    if synced is not None:
+                        self._synced = max(self._synced, synced)
+                    self._sync_cond.notify_all()
+
+    @property
+    def acked(self):
+        return self._acked
+
+    def pending(self, limit=None, max_bytes=None):
+        """Returns up to limit (sequence, data) records not acknowledged
+        yet, in order, holding at most max_bytes of data but always at
+        least one record.
+        """
+        with self._lock:
+            self._fd.flush()
+            segments = list(self._segments)
+            cursor = self._cursor
+
+        start = 0
+        offset = 0
+        paths = [path for _, path in segments]
+        if cursor is not None and cursor[0] in paths:
+            start = paths.index(cursor[0])
+            offset = cursor[1]
+        else:
+            # Skip segments entirely covered by the acked sequence
+            while start + 1 < len(segments) and \
+                    segments[start + 1][0] <= self._acked + 1:
+                start += 1
+
+        records = []
+        size = 0
+        self._read_ends = {}
+        for path in paths[start:]:
+            for record_offset, seq, data in _read_records(path, offset):
+                if seq > self._acked:
+                    size += len(data)
+                    if records and max_bytes is not None and \
+                            size > max_bytes:
+                        return records
+                    records.append((seq, data))
+                    self._read_ends[seq] = (
+                        path, record_offset + _RECORD.size + len(data))
+                    if limit is not None and len(records) >= limit:
+                        return records
+            offset = 0
+        return records
+
+    def ack(self, seq):
+        """Records that every record up to seq is done with and deletes
+        the segments holding only such records.
+        """
+        if seq <= self._acked:
+            return
+        path = os.path.join(self._directory, _ACKED)
+        with open(path + '.tmp', 'w') as fd:
+            fd.write(str(seq))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(path + '.tmp', path)
+        self._acked = seq
+        with self._lock:
+            self._cursor = self._read_ends.get(seq)
+        self._compact()
+
+    def _compact(self):
+        with self._lock:
+            while len(self._segments) > 1 and \
+                    self._segments[1][0] <= self._acked + 1:
+                _, path = self._segments.pop(0)
+                os.unlink(path)
+                LOGGER.debug('Compacted outbox segment %s', path)
+
+    def close(self):
+        with self._lock:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self._fd.close()
+
+
+class OutboxDrainer:
+    """Sends the records of an outbox through a WeClient.
+
+    Records are sent in order, in POSTs of up to max_in_flight records,
+    max_batches batches and max_bytes bytes, and are acknowledged once
+    their batches are committed or known to be invalid. A record larger
+    than the bounds is still sent, alone. While the endpoints fail, the
+    drainer backs off exponentially.
+
+    Args:
+        outbox (Outbox): The outbox to drain.
+        client (WeClient): The client sending the batches.
+        max_in_flight (int): The number of records sent before waiting
+            for their statuses.
+        wait (int): Seconds the REST API waits for the batches to commit.
+        max_batches (int): The number of batches sent at most at once.
+        max_bytes (int): The size in bytes of a POST at most, below the
+            client_max_size of the REST API.
+    """
+
+    def __init__(self, outbox, client, max_in_flight=64, wait=10,
+                 max_backoff=30.0, max_batches=256,
+                 max_bytes=8 * 1024 * 1024):
+        self._outbox = outbox
+        self._client = client
+        self._max_in_flight = max_in_flight
+        self._max_batches = max_batches
+        self._max_bytes = max_bytes
+        self._wait = wait
+        self._max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='we-outbox-drainer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def notify(self):
+        """Wakes the drainer up after an append."""
+        self._wakeup.set()
+
+    def _run(self):
+        backoff = 0.1
+        while not self._stop.is_set():
+            try:
+                drained = self.drain_once()
+            except WeException as err:
+                LOGGER.warning(
+                    'Outbox drain failed, retrying in %.1fs: %s',
+                    backoff, err)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+                continue
+            backoff = 0.1
+            if not drained:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+
+    def drain_once(self):
+        """Sends the next pending records and acknowledges the done ones.
+
+        Returns:
+            (int): The number of records acknowledged.
+        """
+        records = self._outbox.pending(
+            limit=self._max_in_flight, max_bytes=self._max_bytes)
+        if not records:
+            return 0
+
+        batch_ids = {}
+        batches = 0
+        for index, (seq, data) in enumerate(records):
+            batch_list = BatchList()
+            batch_list.ParseFromString(data)
+            ids = [b.header_signature for b in batch_list.batches]
+            if batch_ids and batches + len(ids) > self._max_batches:
+                records = records[:index]
+                break
+            batch_ids[seq] = ids
+            batches += len(ids)
+
+        # Concatenated BatchList encodings are the encoding of the BatchList
+        # holding all their batches, so the records go in a single POST
+        self._client.post_batches(b''.join(data for _, data in records))
+
+        statuses = self._client.get_batch_statuses(
+            [i for ids in batch_ids.values() for i in ids], self._wait)
+
+        # Only acknowledge a contiguous prefix, the acked file holds one
+        # sequence number
+        acked = None
+        for seq, _ in records:
+            done = True
+            for batch_id in batch_ids[seq]:
+                status = statuses.get(batch_id, {}).get('status')
+                if status == 'INVALID':
+                    LOGGER.error(
+                        'Dropping invalid batch %s of outbox record %d: %s',
+                        batch_id, seq,
+                        statuses[batch_id].get('invalid_transactions'))
+                elif status != 'COMMITTED':
+                    done = False
+            if not done:
+                break
+            acked = seq
+
+        if acked is not None:
+            self._outbox.ack(acked)
+            return acked - records[0][0] + 1
+        # Nothing committed yet, give the validator time
+        time.sleep(0.1)
+        return 0
@@ -0,0 +1,147 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import itertools
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+STRATEGIES = ('round-robin', 'least-latency')
+
+
+class Endpoint:
+    """A REST API endpoint and the state of its circuit breaker.
+
+    The circuit opens after failure_threshold consecutive failures and
+    stays open for cooldown seconds, or until a health probe succeeds.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.failures = 0
+        self.open_until = 0.0
+        # Exponentially weighted moving average of the request latency
+        self.latency = None
+
+    def available(self, now):
+        return now >= self.open_until
+
+    def __repr__(self):
+        return "{}(url={})".format(self.__class__.__name__, repr(self.url))
+
+
+class EndpointPool:
+    """Routes requests over several REST API endpoints.
+
+    Args:
+        urls (list of str): The endpoints.
+        strategy (str): 'round-robin' or 'least-latency'.
+        failure_threshold (int): Consecutive failures opening the circuit.
+        cooldown (float): Seconds an open circuit rejects requests.
+    """
+
+    def __init__(self, urls, strategy='round-robin', failure_threshold=3,
+                 cooldown=10.0):
+        if not urls:
+            raise ValueError('At least one endpoint is required')
+        if strategy not in STRATEGIES:
+            raise ValueError('Invalid routing strategy: {}'.format(strategy))
+        self._endpoints = [Endpoint(url) for url in urls]
+        self._strategy = strategy
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._probes = None
+        self._stop_probes = threading.Event()
+
+    @property
+    def endpoints(self):
+        return list(self._endpoints)
+
+    def candidates(self):
+        """Returns the endpoints in the order they should be tried.
+
+        Endpoints with an open circuit come last, so that a request is
+        still attempted when every circuit is open.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._strategy == 'round-robin':
+                start = next(self._next) % len(self._endpoints)
+                ordered = self._endpoints[start:] + self._endpoints[:start]
+            else:
+                # Unmeasured endpoints go first so they get a latency
+                ordered = sorted(
+                    self._endpoints,
+                    key=lambda e: -1 if e.latency is None else e.latency)
+            return [e for e in ordered if e.available(now)] + \
+                [e for e in ordered if not e.available(now)]
+
+    def record_success(self, endpoint, latency):
+        with self._lock:
+            endpoint.failures = 0
+            endpoint.open_until = 0.0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency = 0.8 * endpoint.latency + 0.2 * latency
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures >= self._failure_threshold:
+                if endpoint.available(time.monotonic()):
+                    LOGGER.warning(
+                        'Opening circuit of %s after %d failures',
+                        endpoint.url, endpoint.failures)
+                endpoint.open_until = time.monotonic() + self._cooldown
+
+    def start_probes(self, probe, interval=5.0):
+        """Calls probe(url) on every endpoint every interval seconds.
+
+        probe returns normally when the endpoint is healthy and raises
+        otherwise; a successful probe closes the circuit.
+        """
+        if self._probes is not None:
+            return
+        self._stop_probes.clear()
+        self._probes = threading.Thread(
+            target=self._probe_loop, args=(probe, interval),
+            name='we-health-probes', daemon=True)
+        self._probes.start()
+
+    def stop_probes(self):
+        if self._probes is None:
+            return
+        self._stop_probes.set()
+        self._probes.join()
+        self._probes = None
+
+    def _probe_loop(self, probe, interval):
+        while not self._stop_probes.wait(interval):
+            for endpoint in self._endpoints:
+                start = time.monotonic()
+                try:
+                    probe(endpoint.url)
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.debug(
+                        'Health probe of %s failed: %s', endpoint.url, err)
+                    self.record_failure(endpoint)
+                else:
+                    self.record_success(endpoint, time.monotonic() - start)
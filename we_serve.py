@@ -0,0 +1,320 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Local ingestion daemon accepting records over a Unix domain socket.
+
+The daemon keeps a signing WeClient warm, with its connection pool and
+coalescing submitter, so a CLI invocation costs one IPC round trip
+instead of loading a key and opening connections. Every message is a
+frame:
+
+    uint32 big-endian length | body
+
+A request body is an operation byte followed by its argument; a set
+carries the record as 'name-ids-consumptions-flags-wait', with the same
+separators as the transaction payload. A response body is a status byte,
+'+' or '!', followed by the UTF-8 response or error message. Responses
+come back in the order of the requests, so clients may pipeline. The
+response to an info request is the JSON object of the client settings.
+"""
+
+import collections
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+from sawtooth_we.we_exceptions import WeException
+
+
+LOGGER = logging.getLogger(__name__)
+
+SOCKET_FILE = 'we.sock'
+
+OP_SET = b's'
+OP_PING = b'p'
+OP_INFO = b'i'
+
+STATUS_OK = b'+'
+STATUS_ERROR = b'!'
+
+# A frame holds one record, bound it to refuse garbage lengths
+MAX_FRAME = 16 * 1024 * 1024
+
+_FRAME = struct.Struct('>I')
+
+
+def default_socket_path():
+    return os.path.join(os.path.expanduser("~"), ".sawtooth", SOCKET_FILE)
+
+
+def _send_frame(sock, body):
+    sock.sendall(_FRAME.pack(len(body)) + body)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _recv_frame(sock):
+    """Returns the body of the next frame, None at end of stream."""
+    header = _recv_exactly(sock, _FRAME.size)
+    if header is None:
+        return None
+    length, = _FRAME.unpack(header)
+    if length > MAX_FRAME:
+        raise WeException('Frame of {} bytes is too large'.format(length))
+    body = _recv_exactly(sock, length)
+    if body is None:
+        raise WeException('Connection closed in the middle of a frame')
+    return body
+
+
+def encode_set(name, listId, listConsumption, wait=None, index=False,
+               blind=False):
+    flags = [
+        flag for flag, enabled in (('index', index), ('blind', blind))
+        if enabled]
+    return OP_SET + "-".join([
+        name,
+        ",".join(str(i) for i in listId),
+        ",".join(str(c) for c in listConsumption),
+        ",".join(flags),
+        str(wait or 0)]).encode()
+
+
+def _decode_set(body):
+    try:
+        name, listId, listConsumption, flags, wait = \
+            body.decode().split("-")
+        flags = flags.split(",") if flags else []
+        return (
+            name,
+            [int(i) for i in listId.split(",")],
+            [int(c) for c in listConsumption.split(",")],
+            int(wait),
+            'index' in flags,
+            'blind' in flags)
+    except ValueError as err:
+        raise WeException('Invalid set request') from err
+
+
+class WeDaemon:
+    """Serves set requests on a Unix socket through one WeClient.
+
+    Args:
+        client (WeClient): A signing client, coalescing so that set
+            returns futures and concurrent records share POSTs.
+        path (str): The path of the socket.
+    """
+
+    def __init__(self, client, path=None):
+        self._client = client
+        self._path = path or default_socket_path()
+        self._server = None
+        self._stop = threading.Event()
+
+    def serve_forever(self):
+        """Accepts connections until stop is called."""
+        if os.path.exists(self._path):
+            running = connect_daemon(self._path)
+            if running is not None:
+                running.close()
+                raise WeException(
+                    'A daemon is already serving {}'.format(self._path))
+            # Left over by a daemon which did not exit cleanly
+            os.unlink(self._path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._path)
+        os.chmod(self._path, 0o600)
+        self._server.listen(64)
+        LOGGER.info('Serving on %s', self._path)
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn, _ = self._server.accept()
+                except OSError:
+                    if self._stop.is_set():
+                        break
+                    raise
+                threading.Thread(
+                    target=self._handle, args=(conn,),
+                    name='we-serve-conn', daemon=True).start()
+        finally:
+            self._server.close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown(socket.SHUT_RDWR)
+
+    def _handle(self, conn):
+        # The reader submits the requests, the writer answers them in
+        # order as their futures complete
+        responses = collections.deque()
+        ready = threading.Condition()
+        writer = threading.Thread(
+            target=self._write_responses, args=(conn, responses, ready),
+            name='we-serve-writer', daemon=True)
+        writer.start()
+        try:
+            while True:
+                try:
+                    body = _recv_frame(conn)
+                except (OSError, WeException) as err:
+                    LOGGER.debug('Dropping connection: %s', err)
+                    break
+                if body is None:
+                    break
+                response = self._execute(body)
+                with ready:
+                    responses.append(response)
+                    ready.notify()
+        finally:
+            with ready:
+                responses.append(None)
+                ready.notify()
+            writer.join()
+            conn.close()
+
+    def _execute(self, body):
+        """Returns a Future, or the response itself, of a request."""
+        op, argument = body[:1], body[1:]
+        try:
+            if op == OP_PING:
+                return 'pong'
+            if op == OP_INFO:
+                return json.dumps(self._client.settings, sort_keys=True)
+            if op == OP_SET:
+                name, listId, listConsumption, wait, index, blind = \
+                    _decode_set(argument)
+                return self._client.set(
+                    name, listId, listConsumption, wait=wait,
+                    index=index, blind=blind)
+            raise WeException('Unknown operation {!r}'.format(op))
+        except WeException as err:
+            return err
+
+    def _write_responses(self, conn, responses, ready):
+        while True:
+            with ready:
+                while not responses:
+                    ready.wait()
+                response = responses.popleft()
+            if response is None:
+                return
+            if hasattr(response, 'result'):
+                try:
+                    response = response.result()
+                except WeException as err:
+                    response = err
+            if isinstance(response, Exception):
+                body = STATUS_ERROR + str(response).encode()
+            else:
+                body = STATUS_OK + str(response).encode()
+            try:
+                _send_frame(conn, body)
+            except OSError as err:
+                LOGGER.debug('Failed to answer: %s', err)
+
+
+def connect_daemon(path=None):
+    """Returns a DaemonConnection, or None when no daemon is serving."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or default_socket_path())
+    except OSError:
+        sock.close()
+        return None
+    return DaemonConnection(sock)
+
+
+class DaemonConnection:
+    """The client side of a WeDaemon socket."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_response(self):
+        body = _recv_frame(self._sock)
+        if body is None:
+            raise WeException('The daemon closed the connection')
+        return body[:1] == STATUS_OK, body[1:].decode()
+
+    def ping(self):
+        try:
+            _send_frame(self._sock, OP_PING)
+            return self._read_response()[0]
+        except OSError as err:
+            raise WeException(
+                'Connection to the daemon failed: {}'.format(err)) from err
+
+    def info(self):
+        """Returns the settings of the client of the daemon, see
+        WeClient.settings.
+        """
+        try:
+            _send_frame(self._sock, OP_INFO)
+            ok, message = self._read_response()
+        except OSError as err:
+            raise WeException(
+                'Connection to the daemon failed: {}'.format(err)) from err
+        if not ok:
+            raise WeException(message)
+        return json.loads(message)
+
+    def set_many(self, records, wait=None, index=False, blind=False,
+                 window=256):
+        """Sends records, keeping up to window requests in flight.
+
+        Yields:
+            (tuple): name (str), ok (bool) and the response or error
+                message (str), in the order of the records.
+        """
+        in_flight = collections.deque()
+        try:
+            for name, listId, listConsumption in records:
+                _send_frame(self._sock, encode_set(
+                    name, listId, listConsumption, wait=wait, index=index,
+                    blind=blind))
+                in_flight.append(name)
+                if len(in_flight) >= window:
+                    yield (in_flight.popleft(),) + self._read_response()
+            while in_flight:
+                yield (in_flight.popleft(),) + self._read_response()
+        except OSError as err:
+            raise WeException(
+                'Connection to the daemon failed: {}'.format(err)) from err
@@ -0,0 +1,228 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+from sawtooth_we.we_exceptions import WeException
+from sawtooth_we.we_tracing import LatencyHistogram
+from sawtooth_we.we_tracing import SubmissionTrace
+
+from sawtooth_sdk.protobuf.batch_pb2 import BatchList
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Bucket bounds of the flushed batch sizes: 1, 2, 4, ... 65536
+SIZE_BOUNDS = tuple(2 ** i for i in range(17))
+
+_STOP = object()
+
+
+class _Pending:
+    """A signed transaction waiting in the queue."""
+
+    def __init__(self, name, transaction, wait):
+        self.name = name
+        self.transaction = transaction
+        self.wait = wait
+        self.future = concurrent.futures.Future()
+        self.enqueued = time.monotonic()
+
+
+class CoalescingSubmitter:
+    """Merges transactions submitted one at a time into bulk submissions.
+
+    A worker thread takes the queued transactions and flushes them once
+    max_batch are queued or the oldest one waited max_delay seconds,
+    whichever comes first. Each transaction keeps its own batch, so an
+    invalid record does not drag the others down, but all the batches of
+    a flush go in a single BatchList POST. Waiting for the batches to
+    commit is left to a pool of waiter threads, so the worker goes on
+    coalescing meanwhile.
+
+    Args:
+        client (WeClient): The client signing and sending the batches.
+        max_batch (int): The number of transactions flushed at most at once.
+        max_delay (float): Seconds a transaction waits at most in the queue.
+        max_queued (int): The queue depth past which submit blocks.
+        enqueue_timeout (float): Seconds submit blocks on a full queue
+            before failing, None blocks until there is room.
+        max_waiting (int): The number of flushes waited for at once.
+    """
+
+    def __init__(self, client, max_batch=256, max_delay=0.05,
+                 max_queued=10000, enqueue_timeout=None, max_waiting=4):
+        self._client = client
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._closed = False
+
+        self.batch_sizes = LatencyHistogram(bounds=SIZE_BOUNDS)
+        self.delays = LatencyHistogram()
+
+        self._waiters = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_waiting, thread_name_prefix='we-submitter-wait')
+
+        self._thread = threading.Thread(
+            target=self._run, name='we-submitter', daemon=True)
+        self._thread.start()
+
+    def submit(self, name, transaction, wait=None):
+        """Queues a signed transaction.
+
+        Returns:
+            (concurrent.futures.Future): Resolves to the response of the
+                REST API, or fails with a WeException if the batch is
+                found invalid while waiting.
+
+        Raises:
+            WeException: The submitter is closed, or the queue stayed full
+                for enqueue_timeout seconds.
+        """
+        if self._closed:
+            raise WeException('Submitter is closed')
+        pending = _Pending(name, transaction, wait)
+        try:
+            self._queue.put(pending, timeout=self._enqueue_timeout)
+        except queue.Full as err:
+            raise WeException(
+                'Submission queue full ({} transactions)'.format(
+                    self._queue.maxsize)) from err
+        return pending.future
+
+    def close(self):
+        """Flushes the queued transactions, stops the worker and waits
+        for the flushes still waiting for their statuses.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._waiters.shutdown(wait=True)
+
+    def summary(self):
+        return {
+            'batch_size': self.batch_sizes.summary(),
+            'delay': self.delays.summary(),
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            items = [item]
+            deadline = item.enqueued + self._max_delay
+            while len(items) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+            self._flush(items)
+
+        # Whatever was queued behind the stop marker is still sent
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                items.append(item)
+        for start in range(0, len(items), self._max_batch):
+            self._flush(items[start:start + self._max_batch])
+
+    def _flush(self, items):
+        now = time.monotonic()
+        self.batch_sizes.observe(len(items))
+        for item in items:
+            self.delays.observe(now - item.enqueued)
+
+        try:
+            self._submit(items)
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.warning(
+                'Failed to submit %d coalesced transactions: %s',
+                len(items), err)
+            _fail(items, err)
+
+    def _submit(self, items):
+        client = self._client
+        trace = SubmissionTrace('batch of {}'.format(len(items)))
+        trace.mark('build')
+        batch_list = BatchList(batches=[
+            client.create_batch([item.transaction]) for item in items])
+        trace.batch_id = batch_list.batches[0].header_signature
+        trace.mark('sign')
+
+        # The batches are waited for together by a waiter thread
+        try:
+            response = client.submit_batch_list(
+                batch_list, trace.batch_id, trace)
+        finally:
+            client.record_trace(trace)
+
+        waits = [item.wait for item in items if item.wait and item.wait > 0]
+        if not waits:
+            for item in items:
+                item.future.set_result(response)
+            return
+
+        self._waiters.submit(
+            self._resolve, items, batch_list.batches, max(waits), response)
+
+    def _resolve(self, items, batches, wait, response):
+        """Waits for the statuses of a flush and resolves its futures."""
+        try:
+            statuses = self._client.get_batch_statuses(
+                [batch.header_signature for batch in batches], wait)
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.warning(
+                'Failed to get the statuses of %d coalesced transactions: %s',
+                len(items), err)
+            _fail(items, err)
+            return
+        for item, batch in zip(items, batches):
+            entry = statuses.get(batch.header_signature, {})
+            if entry.get('status') == 'INVALID':
+                item.future.set_exception(WeException(
+                    'Transaction for {} is invalid: {}'.format(
+                        item.name,
+                        entry.get('invalid_transactions'))))
+            else:
+                item.future.set_result(response)
+
+
+def _fail(items, err):
+    if not isinstance(err, WeException):
+        err = WeException(err)
+    for item in items:
+        if not item.future.done():
+            item.future.set_exception(err)
@@ -0,0 +1,170 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import bisect
+import json
+import threading
+import time
+
+
+# Submission stages, in the order they happen
+STAGES = ('build', 'sign', 'send', 'accepted', 'committed')
+
+
+class SubmissionTrace:
+    """Timestamps of the stages of one submission.
+
+    Marks are taken with time.perf_counter() and exported relative to the
+    start of the submission, together with the wall clock start time.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.batch_id = None
+        self.status = None
+        self.wall_time = time.time()
+        self._start = time.perf_counter()
+        self._marks = {}
+
+    def mark(self, stage):
+        self._marks[stage] = time.perf_counter()
+
+    def elapsed(self, stage):
+        """Returns the seconds from the start to the stage, or None."""
+        if stage not in self._marks:
+            return None
+        return self._marks[stage] - self._start
+
+    def durations(self):
+        """Returns the seconds spent in each reached stage.
+
+        The duration of a stage is the time since the previous reached
+        stage, so 'committed' is the time spent waiting for the commit
+        after the batch was accepted.
+        """
+        durations = {}
+        previous = self._start
+        for stage in STAGES:
+            if stage in self._marks:
+                durations[stage] = self._marks[stage] - previous
+                previous = self._marks[stage]
+        return durations
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'batch_id': self.batch_id,
+            'status': self.status,
+            'time': self.wall_time,
+            'elapsed': {
+                stage: self.elapsed(stage)
+                for stage in STAGES if stage in self._marks},
+        }
+
+
+class LatencyHistogram:
+    """Fixed exponential buckets from 100us to about 100s.
+
+    Args:
+        bounds (tuple): Other increasing bucket upper bounds, e.g. to
+            count sizes instead of durations.
+    """
+
+    BOUNDS = tuple(0.0001 * 2 ** i for i in range(21))
+
+    def __init__(self, bounds=None):
+        if bounds is not None:
+            self.BOUNDS = tuple(bounds)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.BOUNDS, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._total += value
+            self._max = max(self._max, value)
+
+    @property
+    def count(self):
+        return self._count
+
+    def mean(self):
+        return self._total / self._count if self._count else None
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket holding the q-th
+        percentile (0 < q <= 100), or None when empty.
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            rank = q / 100.0 * self._count
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank:
+                    if index < len(self.BOUNDS):
+                        return self.BOUNDS[index]
+                    return self._max
+        return self._max
+
+    def summary(self):
+        return {
+            'count': self._count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self._max,
+        }
+
+
+class HistogramSink:
+    """Keeps an in-memory latency histogram per stage."""
+
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+
+    def record(self, trace):
+        for stage, duration in trace.durations().items():
+            self.histograms[stage].observe(duration)
+
+    def summary(self):
+        return {
+            stage: histogram.summary()
+            for stage, histogram in self.histograms.items()
+            if histogram.count}
+
+
+class NdjsonSink:
+    """Appends one JSON object per trace to a file."""
+
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._fd = open(filename, 'a')
+
+    def record(self, trace):
+        line = json.dumps(trace.to_dict(), sort_keys=True)
+        with self._lock:
+            self._fd.write(line + '\n')
+            self._fd.flush()
+
+    def close(self):
+        self._fd.close()
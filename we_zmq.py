@@ -0,0 +1,272 @@
+# Copyright 2016 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Client requests sent straight to the validator's component endpoint.
+
+This is the protocol the REST API itself speaks to the validator: each
+request is a validator Message with a unique correlation id, sent over a
+DEALER socket. Requests are pipelined, the responses are matched back to
+their callers by correlation id.
+"""
+
+import concurrent.futures
+import logging
+import threading
+import uuid
+
+import zmq
+
+from sawtooth_we.we_exceptions import WeException
+
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatus
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatusRequest
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchStatusResponse
+from sawtooth_sdk.protobuf.client_batch_submit_pb2 import \
+    ClientBatchSubmitResponse
+from sawtooth_sdk.protobuf.client_list_control_pb2 import \
+    ClientPagingControls
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateGetRequest
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateGetResponse
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateListRequest
+from sawtooth_sdk.protobuf.client_state_pb2 import ClientStateListResponse
+from sawtooth_sdk.protobuf.network_pb2 import PingResponse
+from sawtooth_sdk.protobuf.validator_pb2 import Message
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Wakes the io thread up: a request to send, or the stop marker
+_STOP = b''
+
+# ClientBatchStatusRequest.timeout is a uint32, longer waits are clamped
+MAX_STATUS_WAIT = 2 ** 32 - 1
+
+# A DEALER socket queues requests silently while the validator is down,
+# so requests always time out instead of hanging
+DEFAULT_TIMEOUT = 30.0
+
+
+class ZmqTransport:
+    """Sends client requests to a validator over ZMQ.
+
+    The DEALER socket is owned by one io thread. Callers hand their
+    requests over an inproc socket and wait on a Future, so any number of
+    threads can have requests in flight on the one connection.
+
+    Args:
+        url (str): The component endpoint of the validator, such as
+            'tcp://localhost:4004'.
+        timeout (float): Seconds to wait for a response, DEFAULT_TIMEOUT
+            when None. Batch status requests also wait for their wait.
+    """
+
+    def __init__(self, url, timeout=None):
+        self._url = url
+        self._timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        self._context = zmq.Context()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closed = False
+
+        inproc = 'inproc://we-zmq-{}'.format(uuid.uuid4().hex)
+        self._wakeup = self._context.socket(zmq.PULL)
+        self._wakeup.bind(inproc)
+        self._requests = self._context.socket(zmq.PUSH)
+        self._requests.connect(inproc)
+
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(url)
+
+        self._thread = threading.Thread(
+            target=self._run, name='we-zmq', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the io thread and fails the requests still in flight."""
+        with self._send_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._requests.send(_STOP)
+        self._thread.join()
+        self._requests.close(linger=0)
+        self._context.term()
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(WeException('ZMQ transport closed'))
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._wakeup, zmq.POLLIN)
+        try:
+            while True:
+                events = dict(poller.poll())
+                if self._wakeup in events:
+                    data = self._wakeup.recv()
+                    if data == _STOP:
+                        return
+                    self._socket.send(data)
+                if self._socket in events:
+                    self._receive(self._socket.recv_multipart()[-1])
+        finally:
+            self._socket.close(linger=0)
+            self._wakeup.close(linger=0)
+
+    def _receive(self, data):
+        message = Message()
+        message.ParseFromString(data)
+
+        if message.message_type == Message.PING_REQUEST:
+            self._socket.send(Message(
+                correlation_id=message.correlation_id,
+                message_type=Message.PING_RESPONSE,
+                content=PingResponse().SerializeToString(),
+            ).SerializeToString())
+            return
+
+        with self._lock:
+            future = self._pending.pop(message.correlation_id, None)
+        if future is None:
+            LOGGER.debug(
+                'Dropping response %s with no pending request',
+                message.correlation_id)
+            return
+        future.set_result(message)
+
+    def send(self, message_type, content):
+        """Sends a request and returns a Future of the response Message."""
+        correlation_id = uuid.uuid4().hex
+        future = concurrent.futures.Future()
+        future.correlation_id = correlation_id
+        data = Message(
+            correlation_id=correlation_id,
+            message_type=message_type,
+            content=content,
+        ).SerializeToString()
+        with self._send_lock:
+            if self._closed:
+                raise WeException('ZMQ transport closed')
+            # Registered before sending so the response cannot be missed
+            with self._lock:
+                self._pending[correlation_id] = future
+            self._requests.send(data)
+        return future
+
+    def _request(self, message_type, content, response_class,
+                 timeout=None):
+        future = self.send(message_type, content)
+        if timeout is None:
+            timeout = self._timeout
+        try:
+            message = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError as err:
+            with self._lock:
+                self._pending.pop(future.correlation_id, None)
+            raise WeException(
+                'No response from {} after {}s'.format(
+                    self._url, timeout)) from err
+        response = response_class()
+        response.ParseFromString(message.content)
+        return response
+
+    def submit_batches(self, data):
+        """Submits a serialized BatchList.
+
+        The BatchList encoding is also the encoding of the
+        ClientBatchSubmitRequest holding the same batches, both have them
+        as field 1, so the bytes are sent as they are.
+        """
+        response = self._request(
+            Message.CLIENT_BATCH_SUBMIT_REQUEST, data,
+            ClientBatchSubmitResponse)
+        if response.status == ClientBatchSubmitResponse.QUEUE_FULL:
+            raise WeException('Validator batch queue is full')
+        if response.status != ClientBatchSubmitResponse.OK:
+            raise WeException('Batch submission failed: {}'.format(
+                ClientBatchSubmitResponse.Status.Name(response.status)))
+        return 'Batches submitted to {}'.format(self._url)
+
+    def batch_statuses(self, batch_ids, wait):
+        """Returns the status entries of the batches by batch id, in the
+        format of the REST API batch_statuses endpoint. The wait is
+        clamped to MAX_STATUS_WAIT seconds.
+        """
+        wait = min(max(int(wait or 0), 0), MAX_STATUS_WAIT)
+        request = ClientBatchStatusRequest(
+            batch_ids=batch_ids,
+            wait=wait > 0,
+            timeout=wait)
+        timeout = self._timeout + wait
+        response = self._request(
+            Message.CLIENT_BATCH_STATUS_REQUEST,
+            request.SerializeToString(),
+            ClientBatchStatusResponse,
+            timeout=timeout)
+        if response.status != ClientBatchStatusResponse.OK:
+            raise WeException('Batch status request failed: {}'.format(
+                ClientBatchStatusResponse.Status.Name(response.status)))
+        return {
+            status.batch_id: {
+                'id': status.batch_id,
+                'status': ClientBatchStatus.Status.Name(status.status),
+                'invalid_transactions': [
+                    {'id': txn.transaction_id, 'message': txn.message}
+                    for txn in status.invalid_transactions],
+            }
+            for status in response.batch_statuses}
+
+    def get_state(self, address):
+        """Returns the data at address in the current state, or None."""
+        response = self._request(
+            Message.CLIENT_STATE_GET_REQUEST,
+            ClientStateGetRequest(address=address).SerializeToString(),
+            ClientStateGetResponse)
+        if response.status == ClientStateGetResponse.NO_RESOURCE:
+            return None
+        if response.status != ClientStateGetResponse.OK:
+            raise WeException('State request failed: {}'.format(
+                ClientStateGetResponse.Status.Name(response.status)))
+        return response.value
+
+    def list_state(self, prefix):
+        """Returns the data of every address under prefix, by address."""
+        entries = {}
+        start = ''
+        while True:
+            request = ClientStateListRequest(
+                address=prefix,
+                paging=ClientPagingControls(start=start, limit=1000))
+            response = self._request(
+                Message.CLIENT_STATE_LIST_REQUEST,
+                request.SerializeToString(),
+                ClientStateListResponse)
+            if response.status == ClientStateListResponse.NO_RESOURCE:
+                return entries
+            if response.status != ClientStateListResponse.OK:
+                raise WeException('State list request failed: {}'.format(
+                    ClientStateListResponse.Status.Name(response.status)))
+            for entry in response.entries:
+                entries[entry.address] = entry.data
+            start = response.paging.next
+            if not start:
+                return entries